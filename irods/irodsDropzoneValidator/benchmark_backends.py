@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the hash worker backends (process/thread) and scheduling orders (walk/size) of irodsDropzoneValidator
+on a synthetic tree with a mixed file size distribution.
+
+The huge files are created in the directory that is walked last, which is the worst case for the walk order.
+"""
+
+import argparse
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import irodsDropzoneValidator as validator
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=lambda prog: argparse.ArgumentDefaultsHelpFormatter(prog, max_help_position=40, width=100),
+    )
+
+    parser.add_argument("-d", "--dir", metavar="DIR", help="Directory to create the synthetic tree in", default=None)
+    parser.add_argument("-p", "--parallel", metavar="n", type=int, help="Number of hash workers", default=4)
+    parser.add_argument("--tiny", metavar="n", type=int, help="Number of 4 KiB files", default=2000)
+    parser.add_argument("--medium", metavar="n", type=int, help="Number of 8 MiB files", default=50)
+    parser.add_argument("--huge", metavar="n", type=int, help="Number of huge files", default=2)
+    parser.add_argument("--huge-size", metavar="MiB", type=int, help="Size of the huge files", default=512)
+    parser.add_argument("-B", "--block-size", metavar="MiB", type=int, help="Hashing block size", default=8)
+    parser.add_argument("-k", "--keep", action="store_true", help="Keep the synthetic tree afterwards")
+
+    return parser.parse_args()
+
+
+def write_file(os_path, size, block):
+    with open(os_path, "wb") as f:
+        while size > 0:
+            f.write(block[:size])
+            size -= len(block)
+
+
+def make_tree(root, tiny, medium, huge, huge_size):
+    block = os.urandom(1024 * 1024)
+
+    for i in range(tiny):
+        directory = os.path.join(root, "a_tiny", "%03d" % (i // 100))
+        os.makedirs(directory, exist_ok=True)
+        write_file(os.path.join(directory, "tiny_%06d" % i), 4 * 1024, block)
+
+    os.makedirs(os.path.join(root, "b_medium"), exist_ok=True)
+    for i in range(medium):
+        write_file(os.path.join(root, "b_medium", "medium_%04d" % i), 8 * 1024 * 1024, block)
+
+    os.makedirs(os.path.join(root, "z_huge"), exist_ok=True)
+    for i in range(huge):
+        write_file(os.path.join(root, "z_huge", "huge_%02d" % i), huge_size * 1024 * 1024, block)
+
+
+def run(config, files):
+    files = validator.schedule_files(files, config)
+
+    start = time.perf_counter()
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    pool = validator.hash_pool(config)
+    results = [pool.apply_async(validator.checksum_calculator, args=(source_file.path,)) for source_file in files]
+    total_bytes = sum(result.get()[1] for result in results)
+    pool.close()
+    pool.join()
+
+    wall = time.perf_counter() - start
+    cpu = 0
+    for before, after in (
+        (usage_self, resource.getrusage(resource.RUSAGE_SELF)),
+        (usage_children, resource.getrusage(resource.RUSAGE_CHILDREN)),
+    ):
+        cpu += (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+
+    return total_bytes, wall, cpu
+
+
+def main():
+    settings = parse_arguments()
+    validator.logger = validator.setup_custom_logger("irodsDropzoneValidator", logging.WARNING)
+
+    root = tempfile.mkdtemp(prefix="dropzone-benchmark-", dir=settings.dir)
+    try:
+        print("Creating synthetic tree in %s" % root)
+        make_tree(root, settings.tiny, settings.medium, settings.huge, settings.huge_size)
+
+        config = argparse.Namespace(
+            source=root,
+            parallel=settings.parallel,
+            block_size=settings.block_size,
+            read_method="readinto",
+            fadvise=False,
+            scan_threads=1,
+        )
+        files = sorted(validator.walk_source(config))
+
+        print("%-8s %-6s %8s %10s %10s %10s %8s" % ("backend", "order", "files", "wall s", "cpu s", "MB/s", "util"))
+        for backend in ("process", "thread"):
+            for order in ("walk", "size"):
+                config.backend = backend
+                config.order = order
+                total_bytes, wall, cpu = run(config, files)
+                rate = total_bytes / wall / 1e6
+                utilisation = 100 * cpu / wall / config.parallel
+                print(
+                    "%-8s %-6s %8d %10.3f %10.3f %10.1f %7.0f%%"
+                    % (backend, order, len(files), wall, cpu, rate, utilisation)
+                )
+    finally:
+        if not settings.keep:
+            shutil.rmtree(root)
+
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        sys.exit(0)
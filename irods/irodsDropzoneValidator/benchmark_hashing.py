@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the read methods and block sizes of the irodsDropzoneValidator hashing engine.
+
+Run it against files on the dropzone mount you want to tune for, e.g. the NFS/SMB mounts of the ingest servers.
+"""
+
+import argparse
+import os
+import sys
+import time
+from irodsDropzoneValidator import ALGORITHMS, READ_METHODS, hash_file
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=lambda prog: argparse.ArgumentDefaultsHelpFormatter(prog, max_help_position=40, width=100),
+    )
+
+    parser.add_argument("paths", metavar="PATH", nargs="+", help="Files or directories to hash")
+    parser.add_argument(
+        "-m", "--methods", metavar="METHOD", nargs="+", choices=READ_METHODS, help="Read methods", default=READ_METHODS
+    )
+    parser.add_argument(
+        "-b", "--block-sizes", metavar="KiB", nargs="+", type=int, help="Block sizes", default=[4, 1024, 8192]
+    )
+    parser.add_argument(
+        "-a", "--algorithms", metavar="ALGORITHM", nargs="+", choices=ALGORITHMS, help="Digests", default=["sha256"]
+    )
+    parser.add_argument("-r", "--repeat", metavar="n", type=int, help="Runs per combination, best is kept", default=3)
+    parser.add_argument(
+        "--cold",
+        action="store_true",
+        help="Drop the files from the page cache before every run (POSIX_FADV_DONTNEED, best effort on network mounts)",
+    )
+
+    return parser.parse_args()
+
+
+def list_files(paths):
+    files = list()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names)
+        else:
+            files.append(path)
+
+    return files
+
+
+def drop_cache(files):
+    if not hasattr(os, "posix_fadvise"):
+        return
+
+    for os_path in files:
+        fd = os.open(os_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def run(files, method, block_size, fadvise, cold, algorithms):
+    if cold:
+        drop_cache(files)
+
+    # Like a hash worker, one read buffer for all files
+    buffer = bytearray(block_size) if method == "readinto" else None
+    total_bytes = 0
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    for os_path in files:
+        size, digests = hash_file(os_path, block_size, method, fadvise, algorithms, buffer)
+        total_bytes += size
+
+    return total_bytes, time.perf_counter() - start, time.process_time() - cpu_start
+
+
+def main():
+    config = parse_arguments()
+
+    files = list_files(config.paths)
+    if not files:
+        print("No files found")
+        return 1
+
+    print(
+        "%-10s %10s %8s %10s %10s %10s %10s" % ("method", "block KiB", "fadvise", "wall s", "cpu s", "MB/s", "files/s")
+    )
+    for method in config.methods:
+        for block_kib in config.block_sizes:
+            for fadvise in (False, True):
+                best = None
+                for _ in range(config.repeat):
+                    total_bytes, wall, cpu = run(
+                        files, method, block_kib * 1024, fadvise, config.cold, config.algorithms
+                    )
+                    if best is None or wall < best[1]:
+                        best = (total_bytes, wall, cpu)
+
+                total_bytes, wall, cpu = best
+                rate = total_bytes / wall / 1e6 if wall > 0 else 0
+                files_rate = len(files) / wall if wall > 0 else 0
+                print(
+                    "%-10s %10d %8s %10.3f %10.3f %10.1f %10.0f"
+                    % (method, block_kib, fadvise, wall, cpu, rate, files_rate)
+                )
+
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        sys.exit(0)
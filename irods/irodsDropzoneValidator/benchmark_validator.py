@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of irodsDropzoneValidator on a synthetic dropzone tree, validated against an in-process iRODS
+stand-in (fake_irods.py) with a configurable catalog latency. Runs the main validation modes and reports files/s and
+MB/s of the whole tree per mode, so regressions show up without a live iRODS zone.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import irodsDropzoneValidator as validator
+from irods.models import DataObject
+from benchmark_backends import write_file
+from fake_irods import FakeCatalog, FakeSession
+
+# Collection the synthetic tree is validated against
+TARGET = "/benchZone/home/benchmark/dropzone"
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=lambda prog: argparse.ArgumentDefaultsHelpFormatter(prog, max_help_position=40, width=100),
+    )
+
+    parser.add_argument("-d", "--dir", metavar="DIR", help="Directory to create the synthetic tree in", default=None)
+    parser.add_argument("--tiny", metavar="n", type=int, help="Number of tiny files", default=5000)
+    parser.add_argument("--tiny-size", metavar="KiB", type=int, help="Size of the tiny files", default=4)
+    parser.add_argument("--depth", metavar="n", type=int, help="Nesting depth of the tiny files", default=4)
+    parser.add_argument("--medium", metavar="n", type=int, help="Number of medium files", default=50)
+    parser.add_argument("--medium-size", metavar="MiB", type=int, help="Size of the medium files", default=8)
+    parser.add_argument("--huge", metavar="n", type=int, help="Number of huge files", default=2)
+    parser.add_argument("--huge-size", metavar="MiB", type=int, help="Size of the huge files", default=256)
+    parser.add_argument(
+        "-l", "--latency", metavar="ms", type=float, help="Latency of every iCAT round trip", default=2.0
+    )
+    parser.add_argument("-p", "--parallel", metavar="n", type=int, help="Number of hash workers", default=4)
+    parser.add_argument(
+        "-n", "--connections", metavar="n", type=int, help="Number of connections of the lookup modes", default=8
+    )
+    parser.add_argument("--backend", choices=["process", "thread"], help="Hash worker backend", default="process")
+    parser.add_argument("-o", "--output", metavar="FILE", help="Also write the results as JSON", default=None)
+    parser.add_argument("-k", "--keep", action="store_true", help="Keep the synthetic tree afterwards")
+
+    return parser.parse_args()
+
+
+def make_tree(root, settings):
+    """
+    Synthetic dropzone: tiny files spread over a tree of --depth levels with 10 subdirectories each, and the medium
+    and huge files at the top.
+    """
+    block = os.urandom(1024 * 1024)
+
+    for i in range(settings.tiny):
+        parts = list()
+        n = i // 10
+        for _ in range(settings.depth):
+            parts.append("d%d" % (n % 10))
+            n //= 10
+        directory = os.path.join(root, "tiny", *parts)
+        os.makedirs(directory, exist_ok=True)
+        write_file(os.path.join(directory, "tiny_%06d" % i), settings.tiny_size * 1024, block)
+
+    os.makedirs(os.path.join(root, "medium"), exist_ok=True)
+    for i in range(settings.medium):
+        write_file(os.path.join(root, "medium", "medium_%04d" % i), settings.medium_size * 1024 * 1024, block)
+
+    os.makedirs(os.path.join(root, "huge"), exist_ok=True)
+    for i in range(settings.huge):
+        write_file(os.path.join(root, "huge", "huge_%02d" % i), settings.huge_size * 1024 * 1024, block)
+
+
+def scenarios(settings, work):
+    """Name and extra arguments of every validation mode that is measured"""
+    cache = os.path.join(work, "cache.db")
+    return [
+        ("quick", ["--quick"]),
+        ("size-check", []),
+        ("lookups", ["--skip-size-check", "-n", "1"]),
+        ("lookups-concurrent", ["--skip-size-check", "-n", str(settings.connections)]),
+        ("sample-10%", ["--sample", "0.1", "-c"]),
+        ("cache-cold", ["-C", cache]),
+        ("cache-warm", ["-C", cache]),
+    ]
+
+
+def run(settings, root, work, arguments):
+    """Run the validator once. Returns the exit code, wall time and the metrics it wrote."""
+    metrics_file = os.path.join(work, "metrics.json")
+    sys.argv = [
+        "irodsDropzoneValidator.py",
+        "-s",
+        root,
+        "-t",
+        TARGET,
+        "-q",
+        "-p",
+        str(settings.parallel),
+        "--backend",
+        settings.backend,
+        "--metrics",
+        metrics_file,
+    ] + arguments
+
+    start = time.perf_counter()
+    exit_code = validator.main()
+    wall = time.perf_counter() - start
+
+    with open(metrics_file) as f:
+        metrics = json.load(f)
+
+    return exit_code, wall, metrics
+
+
+def main():
+    settings = parse_arguments()
+    validator.logger = validator.setup_custom_logger("irodsDropzoneValidator", logging.WARNING)
+
+    work = tempfile.mkdtemp(prefix="dropzone-benchmark-", dir=settings.dir)
+    root = os.path.join(work, "dropzone")
+    results = list()
+    try:
+        print("Creating synthetic tree in %s" % root)
+        make_tree(root, settings)
+        catalog = FakeCatalog.from_directory(root, TARGET)
+        total_files = len(catalog.rows)
+        total_bytes = sum(row[DataObject.size] for row in catalog.rows)
+
+        # Every connection of the validator gets its own session on the shared catalog
+        validator.irods_session = lambda config: FakeSession(catalog, settings.latency / 1000)
+
+        print("%-20s %8s %12s %10s %10s %10s %6s" % ("mode", "files", "bytes", "wall s", "files/s", "MB/s", "exit"))
+        for name, arguments in scenarios(settings, work):
+            exit_code, wall, metrics = run(settings, root, work, arguments)
+            result = {
+                "mode": name,
+                "files": total_files,
+                "bytes": total_bytes,
+                "wall_seconds": wall,
+                "files_per_second": total_files / wall,
+                "megabytes_per_second": total_bytes / wall / 1e6,
+                "exit_code": exit_code,
+                "metrics": metrics,
+            }
+            results.append(result)
+            rate = result["megabytes_per_second"]
+            print(
+                "%-20s %8d %12d %10.3f %10.1f %10.1f %6d"
+                % (name, total_files, total_bytes, wall, result["files_per_second"], rate, exit_code)
+            )
+
+        if settings.output:
+            with open(settings.output, "w") as f:
+                json.dump({"settings": vars(settings), "results": results}, f, indent=2)
+    finally:
+        if not settings.keep:
+            shutil.rmtree(work)
+
+    # A synthetic tree validates without errors, anything else is a regression
+    return 0 if all(result["exit_code"] == 0 for result in results) else 1
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,171 @@
+"""
+In-process stand-in for an iRODS session, answering the GenQuery and data object lookups of irodsDropzoneValidator
+from an in-memory catalog. It implements just enough of python-irodsclient to benchmark the validator without a live
+zone, every catalog round trip costs a configurable latency.
+"""
+
+import argparse
+import base64
+import binascii
+import os
+import posixpath
+import threading
+import time
+from irods.exception import CollectionDoesNotExist, DataObjectDoesNotExist
+from irods.models import Collection, DataObject
+import irodsDropzoneValidator as validator
+
+# Rows per GenQuery result page, as returned by the iCAT
+PAGE_SIZE = 500
+
+
+class FakeCatalog:
+    """Data objects as rows of GenQuery columns, with an index by logical path for lookups"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.by_path = {posixpath.join(row[Collection.name], row[DataObject.name]): row for row in rows}
+        self.collections = {row[Collection.name] for row in rows}
+
+    @classmethod
+    def from_directory(cls, source, target, algorithm="sha256", resources=("rootResc",)):
+        """Catalog of a source directory as if it was ingested into target, with a replica per resource"""
+        rows = list()
+        for source_file in validator.walk_source(argparse.Namespace(source=source, scan_threads=4)):
+            size, digests = validator.hash_file(
+                os.path.join(source, source_file.path), 8 * 1024 * 1024, algorithms=(algorithm,)
+            )
+            if algorithm == "sha256":
+                checksum = "sha2:" + base64.b64encode(binascii.unhexlify(digests[algorithm])).decode("utf-8")
+            else:
+                checksum = digests[algorithm]
+
+            path = posixpath.join(target, source_file.path.replace(os.sep, "/"))
+            for replica_number, resource in enumerate(resources):
+                rows.append(
+                    {
+                        DataObject.id: len(rows),
+                        Collection.name: posixpath.dirname(path),
+                        DataObject.name: posixpath.basename(path),
+                        DataObject.size: size,
+                        DataObject.checksum: checksum,
+                        DataObject.replica_number: replica_number,
+                        DataObject.resc_hier: resource,
+                    }
+                )
+
+        return cls(rows)
+
+
+class FakeQuery:
+    """GenQuery over the catalog rows, supporting the = and like conditions"""
+
+    def __init__(self, session, columns, criteria=()):
+        self.session = session
+        self.columns = columns
+        self.criteria = list(criteria)
+
+    def filter(self, *criteria):
+        return FakeQuery(self.session, self.columns, self.criteria + list(criteria))
+
+    def matches(self, row):
+        for criterion in self.criteria:
+            value = str(row[criterion.query_key])
+            expected = criterion.value.strip("'")
+            if criterion.op == "=" and value != expected:
+                return False
+            if criterion.op == "like" and not like(value, expected):
+                return False
+        return True
+
+    def __iter__(self):
+        # Every page of results is a round trip
+        n = 0
+        for row in self.session.catalog.rows:
+            if self.matches(row):
+                if n % PAGE_SIZE == 0:
+                    self.session.round_trip()
+                n += 1
+                yield {column: row[column] for column in self.columns}
+        if n == 0:
+            self.session.round_trip()
+
+
+def like(value, pattern):
+    """SQL LIKE of the iCAT, only the % wildcard is supported"""
+    parts = pattern.split("%")
+    if len(parts) == 1:
+        return value == pattern
+    if not value.startswith(parts[0]) or not value.endswith(parts[-1]):
+        return False
+
+    position = len(parts[0])
+    for part in parts[1:-1]:
+        position = value.find(part, position)
+        if position < 0:
+            return False
+        position += len(part)
+
+    return position <= len(value) - len(parts[-1])
+
+
+class FakeDataObject:
+    def __init__(self, row):
+        self.name = row[DataObject.name]
+        self.size = row[DataObject.size]
+        self.checksum = row[DataObject.checksum]
+
+
+class FakeDataObjectManager:
+    def __init__(self, session):
+        self.session = session
+
+    def get(self, path):
+        # A data object lookup costs several round trips in python-irodsclient
+        for _ in range(self.session.lookup_round_trips):
+            self.session.round_trip()
+
+        row = self.session.catalog.by_path.get(path)
+        if row is None:
+            if posixpath.dirname(path) not in self.session.catalog.collections:
+                raise CollectionDoesNotExist()
+            raise DataObjectDoesNotExist()
+        return FakeDataObject(row)
+
+
+class FakeCollectionManager:
+    def __init__(self, session):
+        self.session = session
+
+    def get(self, path):
+        self.session.round_trip()
+        if not any(c == path or c.startswith(path.rstrip("/") + "/") for c in self.session.catalog.collections):
+            raise CollectionDoesNotExist()
+
+
+class FakeSession:
+    """
+    Session on the in-memory catalog. Every round trip to the iCAT sleeps for latency seconds, which releases the
+    GIL like waiting on a socket does, so concurrent sessions overlap their latency.
+    """
+
+    def __init__(self, catalog, latency=0.0, lookup_round_trips=3):
+        self.catalog = catalog
+        self.latency = latency
+        self.lookup_round_trips = lookup_round_trips
+        self.data_objects = FakeDataObjectManager(self)
+        self.collections = FakeCollectionManager(self)
+        self.lock = threading.Lock()
+        self.round_trips = 0
+
+    def round_trip(self):
+        with self.lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def query(self, *columns):
+        return FakeQuery(self, columns)
+
+    def cleanup(self):
+        pass
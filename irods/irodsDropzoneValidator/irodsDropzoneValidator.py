@@ -2,16 +2,76 @@
 import argparse
 import base64
 import binascii
+import contextlib
+import csv
+import ctypes
 import hashlib
+import json
 import logging
+import math
+import mmap
 import os
+import posixpath
+import queue
+import select
 import signal
+import sqlite3
+import struct
 import sys
+import threading
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from tqdm import tqdm
+from irods.column import Like
 from irods.exception import *
+from irods.models import Collection, DataObject
 from irods.session import iRODSSession
 
+# Catalog information of a single data object, as kept in the prefetched index. Replicas is a tuple of
+# (resource name, checksum) of every replica, only when all replicas are verified.
+CatalogEntry = namedtuple("CatalogEntry", ["size", "checksum", "replica_number", "replicas"])
+
+# A file in the source directory, path is relative to the source directory. Size, mtime_ns and inode are None for a
+# file that cannot be stat'ed or a directory that cannot be listed.
+SourceFile = namedtuple("SourceFile", ["path", "size", "mtime_ns", "inode"])
+
+# Methods to read a file while hashing, see hash_file()
+READ_METHODS = ["readinto", "mmap", "read"]
+
+# Digests that can be calculated locally, to verify the matching checksums in iRODS against
+ALGORITHMS = ["sha256", "md5"]
+
+# Digests calculated by default in watch mode, which does not know the algorithms of the iRODS checksums yet. iRODS
+# calculates sha256 checksums unless configured otherwise.
+WATCH_ALGORITHMS = ["sha256"]
+
+# Outcomes of the validation of a path, with the message logged for the ones that fail. Extra data objects are only
+# reported, they do not fail the validation.
+OK = "ok"
+EXTRA = "extra"
+OUTCOME_MESSAGES = {
+    "missing": "File `{path}` does not exist in target collection",
+    EXTRA: "Data object `{path}` in target collection does not exist in source directory",
+    "size-mismatch": "File `{path}` has size {local_size}, but {irods_size} in target collection",
+    "no-checksum": "File `{path}` does not have a checksum stored in iRODS",
+    "checksum-mismatch": "File `{path}` does not match checksum",
+    "unsupported-checksum": "File `{path}` has a checksum in iRODS of an unknown or not selected algorithm",
+    "unreadable": "File or directory `{path}` in source directory cannot be stat'ed or listed",
+}
+
+# Configuration of a hash worker, set by init_worker()
+worker_config = None
+
+# Read buffer of a hash worker, allocated once by init_worker(). Thread-local, as the threads of --backend thread
+# share the module globals.
+worker_state = threading.local()
+
+# Number of files per hash worker that may be in between the directory walk and the verification
+QUEUE_SIZE_PER_WORKER = 16
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
@@ -29,9 +89,150 @@ def parse_arguments():
     parser.add_argument(
         "-p", "--parallel", metavar="n", type=int, help="Number of parallel processes running checksum", default=1
     )
+    parser.add_argument(
+        "--backend",
+        choices=["process", "thread"],
+        help="Run checksums in worker processes or in threads of this process",
+        default="process",
+    )
+    parser.add_argument(
+        "--order",
+        choices=["size", "walk"],
+        help="Hash the largest files first, or in the order they were found",
+        default="size",
+    )
+    parser.add_argument(
+        "-P",
+        "--prefetch",
+        action="store_true",
+        help="With --skip-size-check, still list the target collection with one bulk catalog query instead of a "
+        "lookup per file",
+    )
+    parser.add_argument(
+        "-S",
+        "--scan-threads",
+        metavar="n",
+        type=int,
+        help="Number of threads listing directories of the source directory concurrently",
+        default=4,
+    )
+    parser.add_argument(
+        "-n",
+        "--connections",
+        metavar="n",
+        type=int,
+        help="Number of iRODS connections looking up files concurrently, when the target is not listed in bulk",
+        default=1,
+    )
+    parser.add_argument(
+        "-R",
+        "--all-replicas",
+        action="store_true",
+        help="Verify the checksum of every replica instead of one, implies --prefetch",
+    )
+    parser.add_argument(
+        "-C",
+        "--cache",
+        metavar="FILE",
+        help="SQLite file caching local checksums between runs, unchanged files are not hashed again",
+    )
+    parser.add_argument(
+        "-o",
+        "--report",
+        metavar="FILE",
+        help="Write every path that failed validation to a report, CSV or JSON depending on the file extension",
+    )
+    parser.add_argument(
+        "-m",
+        "--metrics",
+        metavar="FILE",
+        help="Write timing and throughput metrics, JSON or else a Prometheus textfile depending on the file extension",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        metavar="FILE",
+        help="SQLite file in which the outcome of every verified file is recorded while validating",
+    )
+    parser.add_argument(
+        "-r",
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted validation, unchanged files in the checkpoint are not verified again",
+    )
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="Only check existence and size of all files against the catalog, do not calculate checksums",
+    )
+    parser.add_argument(
+        "--sample",
+        metavar="FRACTION",
+        type=float,
+        help="Only calculate checksums of a size-weighted random sample of about this fraction of the bytes",
+    )
+    parser.add_argument(
+        "--seed", metavar="SEED", help="Seed of the sample, the same seed picks the same files", default="0"
+    )
+    parser.add_argument(
+        "--skip-size-check",
+        action="store_true",
+        help="Start calculating checksums right away, without checking existence and size of all files first",
+    )
+    parser.add_argument(
+        "-w",
+        "--watch",
+        action="store_true",
+        help="Hash files in the checksum cache as they land in the source directory, until interrupted",
+    )
+    parser.add_argument(
+        "--watch-interval",
+        metavar="SECONDS",
+        type=float,
+        help="Interval of the watch mode at which unchanged files are considered complete",
+        default=10,
+    )
+    parser.add_argument(
+        "--polling",
+        action="store_true",
+        help="Watch by walking the source directory instead of with inotify, e.g. for network mounts",
+    )
+    parser.add_argument(
+        "-a",
+        "--algorithms",
+        metavar="ALGORITHM",
+        nargs="+",
+        choices=ALGORITHMS,
+        help="Digests that may be calculated, each file is only hashed with the ones its iRODS checksums use. "
+        "With --watch only %s by default" % " ".join(WATCH_ALGORITHMS),
+        default=ALGORITHMS,
+    )
+    parser.add_argument(
+        "-B", "--block-size", metavar="MiB", type=int, help="Size of the blocks read while hashing", default=8
+    )
+    parser.add_argument(
+        "--read-method", choices=READ_METHODS, help="How files are read while hashing", default="readinto"
+    )
+    parser.add_argument(
+        "--fadvise",
+        action="store_true",
+        help="Advise the kernel that files are read sequentially (posix_fadvise), mostly useful on local disks",
+    )
 
     settings = parser.parse_args()
 
+    if settings.resume and not settings.checkpoint:
+        parser.error("--resume requires --checkpoint")
+    if settings.watch and not settings.cache:
+        parser.error("--watch requires --cache")
+    # The default list itself is kept when --algorithms is not given
+    if settings.watch and settings.algorithms is ALGORITHMS:
+        settings.algorithms = WATCH_ALGORITHMS
+    if settings.sample is not None:
+        if not 0 < settings.sample <= 1:
+            parser.error("--sample must be a fraction larger than 0 and at most 1")
+        if settings.quick or settings.skip_size_check:
+            parser.error("--sample requires the size check, it cannot be combined with --quick or --skip-size-check")
+
     return settings
 
 
@@ -48,26 +249,491 @@ def setup_custom_logger(name, log_level):
     return log
 
 
-def checksum_calculator(config, p):
-    # Ignore the interrupt signal. Let parent handle that.
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
+def hash_file(os_path, block_size, method="readinto", fadvise=False, algorithms=("sha256",), buffer=None):
+    """
+    Calculate the digests of a local file in a single read. Returns the number of bytes read and the hex digest per
+    algorithm.
+
+    readinto: read into one preallocated buffer, no new bytes object per block. Pass the buffer of the worker to
+              reuse it for every file, otherwise one of at most the file size is allocated for this file.
+    mmap:     map the file in memory and hash it in slices of block_size
+    read:     plain f.read() per block, only kept for comparison in benchmarks
+    """
+    hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+    size = 0
+
+    with open(os_path, "rb", buffering=0) as f:
+        if fadvise and hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        if method == "readinto":
+            if buffer is None:
+                # Zero-filling a whole block would cost more than hashing a small file
+                buffer = bytearray(min(block_size, os.fstat(f.fileno()).st_size or 1))
+            view = memoryview(buffer)
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                block = view[:n]
+                for h in hashes:
+                    h.update(block)
+                size += n
+        elif method == "mmap":
+            # Zero length files cannot be mapped
+            if os.fstat(f.fileno()).st_size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    view = memoryview(m)
+                    try:
+                        for offset in range(0, len(m), block_size):
+                            with view[offset : offset + block_size] as block:
+                                for h in hashes:
+                                    h.update(block)
+                        size = len(m)
+                    finally:
+                        view.release()
+        elif method == "read":
+            for byte_block in iter(lambda: f.read(block_size), b""):
+                for h in hashes:
+                    h.update(byte_block)
+                size += len(byte_block)
+        else:
+            raise ValueError("Unknown read method `%s`" % method)
+
+    return size, {algorithm: h.hexdigest() for algorithm, h in zip(algorithms, hashes)}
+
+
+def init_worker(config):
+    """Initialize a hash worker, the configuration is handed over once instead of with every file"""
+    global worker_config
+    worker_config = config
+    worker_state.buffer = bytearray(config.block_size * 1024 * 1024) if config.read_method == "readinto" else None
+
+    # Ignore the interrupt signal in worker processes. Let parent handle that.
+    if config.backend == "process":
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def hash_pool(config):
+    """
+    Pool of hash workers. Threads are enough to keep multiple cores busy, as hashlib releases the GIL while hashing,
+    and avoid starting processes. Processes are the safe default.
+    """
+    pool_class = ThreadPool if config.backend == "thread" else Pool
+    return pool_class(processes=config.parallel, initializer=init_worker, initargs=(config,))
+
+
+def schedule_files(files, config):
+    """
+    Order the files for hashing. Largest first, so a single huge file does not end up last and keep one worker busy
+    while the others are idle.
+    """
+    if config.order == "size":
+        return sorted(files, key=lambda source_file: source_file.size, reverse=True)
+
+    return files
+
+
+def sample_files(files, config):
+    """
+    Pick a reproducible random sample of the files, with a chance proportional to their size, until the sample holds
+    config.sample of all bytes. Every file gets a key -ln(u) / size (Efraimidis-Spirakis), with u derived from the
+    seed and the path only, so the same seed picks the same files regardless of the walk order.
+    """
+
+    def key(source_file):
+        digest = hashlib.sha256(("%s:%s" % (config.seed, source_file.path)).encode("utf-8")).digest()
+        u = (int.from_bytes(digest[:8], "big") + 1) / (2**64 + 1)
+        return -math.log(u) / max(source_file.size, 1)
+
+    budget = config.sample * sum(source_file.size for source_file in files)
+    sample = list()
+    sampled_bytes = 0
+    for source_file in sorted(files, key=key):
+        if sampled_bytes >= budget:
+            break
+        sample.append(source_file)
+        sampled_bytes += source_file.size
+
+    return sample
+
 
-    os_path = os.path.join(config.source, p)
+def wilson_interval(failures, n, z=1.96):
+    """Confidence interval of a proportion, 95% by default. Unlike the normal approximation it holds for 0 failures."""
+    if n == 0:
+        return 0.0, 1.0
+
+    p = failures / n
+    denominator = 1 + z**2 / n
+    center = (p + z**2 / (2 * n)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / denominator
+
+    return max(0.0, center - half_width), min(1.0, center + half_width)
+
+
+def log_sample_summary(files, sample, outcomes):
+    """Log the coverage of the sample and the estimated corruption rate of the whole source directory"""
+    total_bytes = sum(source_file.size for source_file in files)
+    sampled_bytes = sum(source_file.size for source_file in sample)
+    logger.info(
+        "Sample coverage: %d of %d files (%.2f%%), %d of %d bytes (%.2f%%)"
+        % (
+            len(sample),
+            len(files),
+            100 * len(sample) / len(files) if files else 0,
+            sampled_bytes,
+            total_bytes,
+            100 * sampled_bytes / total_bytes if total_bytes else 0,
+        )
+    )
+
+    verified = sum(outcomes.values())
+    failures = verified - outcomes[OK]
+    low, high = wilson_interval(failures, verified)
+    logger.info(
+        "Sample result: %d of %d verified files failed, estimated size-weighted corruption rate %.4f%% "
+        "(95%% confidence interval %.4f%% - %.4f%%)"
+        % (failures, verified, 100 * failures / verified if verified else 0, 100 * low, 100 * high)
+    )
+
+
+def checksum_calculator(p, algorithms=("sha256",)):
+    started = time.monotonic()
+    os_path = os.path.join(worker_config.source, p)
 
     logger.debug("Calculating checksum for %s" % p)
 
     # Calculate checksum
-    sha256_hash = hashlib.sha256()
-    size = 0
-    with open(os_path, "rb") as f:
-        # Read and update hash string value in blocks of 4K
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-            size += len(byte_block)
+    size, digests = hash_file(
+        os_path,
+        worker_config.block_size * 1024 * 1024,
+        worker_config.read_method,
+        worker_config.fadvise,
+        algorithms,
+        getattr(worker_state, "buffer", None),
+    )
+
+    return p, size, digests, started, time.monotonic() - started
+
+
+class ChecksumCache:
+    """
+    Persistent cache of local digests, a column per algorithm. An entry is only valid as long as the size,
+    modification time and inode of the file are unchanged.
+    """
+
+    # Number of new entries after which the cache is committed to disk
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS checksums "
+            "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, sha256 TEXT)"
+        )
+        # Caches of before md5 was supported only have a sha256 column
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(checksums)")]
+        for algorithm in ALGORITHMS:
+            if algorithm not in columns:
+                self.connection.execute("ALTER TABLE checksums ADD COLUMN %s TEXT" % algorithm)
+        self.hits = 0
+        self.misses = 0
+        self.uncommitted = 0
+
+    def lookup(self, source_file):
+        """All cached digests of the file, by algorithm"""
+        row = self.connection.execute(
+            "SELECT %s FROM checksums WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?"
+            % ", ".join(ALGORITHMS),
+            source_file,
+        ).fetchone()
+
+        if row is None:
+            return dict()
+        return {algorithm: digest for algorithm, digest in zip(ALGORITHMS, row) if digest is not None}
+
+    def get(self, source_file, algorithms):
+        """The cached digests of the file, only when all of the algorithms are cached"""
+        digests = self.lookup(source_file)
+        if not all(algorithm in digests for algorithm in algorithms):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return digests
+
+    def put(self, source_file, digests):
+        # Keep the digests of other algorithms cached for the same file
+        digests = {**self.lookup(source_file), **digests}
+        self.connection.execute(
+            "INSERT OR REPLACE INTO checksums (path, size, mtime_ns, inode, %s) VALUES (?, ?, ?, ?, %s)"
+            % (", ".join(ALGORITHMS), ", ".join("?" * len(ALGORITHMS))),
+            source_file + tuple(digests.get(algorithm) for algorithm in ALGORITHMS),
+        )
+
+        self.uncommitted += 1
+        if self.uncommitted >= self.COMMIT_INTERVAL:
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+class Report:
+    """
+    Outcome of the validation per path. Failures are logged and, when a report file is given, written to it right
+    away, so the report does not have to be kept in memory. The outcomes of all paths are counted for the summary.
+    """
+
+    FIELDS = ["path", "outcome", "local_size", "irods_size", "resources"]
+
+    def __init__(self, config):
+        self.counts = Counter()
+        self.resource_counts = Counter()
+        self.file = None
+
+        if config.report:
+            self.file = open(config.report, "w", newline="")
+            self.json = config.report.endswith(".json")
+            if self.json:
+                header = {"source": config.source, "target": config.target}
+                self.file.write(json.dumps(header)[:-1] + ', "findings": [')
+                self.separator = "\n"
+            else:
+                self.writer = csv.DictWriter(self.file, fieldnames=self.FIELDS)
+                self.writer.writeheader()
+
+    def add(self, outcome, path, local_size=None, irods_size=None, failures=()):
+        """
+        Add the outcome of a path. Failures are the (resource, outcome) pairs of the replicas that failed, if known,
+        and are written to the report as resource:outcome.
+        """
+        self.counts[outcome] += 1
+        if outcome == OK:
+            return
+
+        resources = " ".join("%s:%s" % failure for failure in failures)
+        finding = dict(path=path, outcome=outcome, local_size=local_size, irods_size=irods_size, resources=resources)
+        message = OUTCOME_MESSAGES[outcome].format(**finding)
+        if failures:
+            message += " on resource(s) %s" % ", ".join("%s (%s)" % failure for failure in failures)
+            for failure in failures:
+                self.resource_counts[failure] += 1
+
+        if outcome == EXTRA:
+            logger.warning(message)
+        else:
+            logger.error(message)
+
+        if self.file is None:
+            return
+        if self.json:
+            self.file.write(self.separator + json.dumps(finding))
+            self.separator = ",\n"
+        else:
+            self.writer.writerow(finding)
+
+    def summary(self):
+        return ", ".join("%d %s" % (n, outcome) for outcome, n in sorted(self.counts.items()))
+
+    def resource_summary(self):
+        return ", ".join(
+            "%s: %d %s" % (resource, n, outcome) for (resource, outcome), n in sorted(self.resource_counts.items())
+        )
+
+    def close(self):
+        if self.file is None:
+            return
+        if self.json:
+            resources = dict()
+            for (resource, outcome), n in self.resource_counts.items():
+                resources.setdefault(resource, dict())[outcome] = n
+            summary = {"outcomes": dict(self.counts), "resources": resources}
+            self.file.write('\n], "summary": %s}\n' % json.dumps(summary))
+        self.file.close()
+
 
-        checksum = sha256_hash.hexdigest()
+class Metrics:
+    """
+    Time spent per stage of the validation and the overall throughput, to tell whether a validation is limited by
+    the disk, the CPU or the iCAT. Stages are timed from multiple threads.
 
-    return p, size, checksum
+    catalog_listing: bulk listing of the target collection
+    inventory:       walk of the source directory for the size check
+    walk:            walk of the source directory while hashing, without the size check
+    lookup:          lookup of a single file in iRODS
+    queue_wait:      time a file waited for a free hash worker
+    hash:            reading and hashing a file
+    verify:          comparing and reporting a file
+    checksums:       the whole checksum phase
+    """
+
+    PREFIX = "irods_dropzone_validator"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = dict()
+        self.counters = Counter()
+        self.started = time.monotonic()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            count, total, maximum = self.stages.get(stage, (0, 0.0, 0.0))
+            self.stages[stage] = (count + 1, total + seconds, max(maximum, seconds))
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.monotonic() - start)
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    def throughput(self, config):
+        """Files and bytes per second of the checksum phase and the share of time the hash workers were busy"""
+        checksums = self.stages.get("checksums", (0, 0.0, 0.0))[1]
+        hashing = self.stages.get("hash", (0, 0.0, 0.0))[1]
+        return {
+            "elapsed_seconds": time.monotonic() - self.started,
+            "files_per_second": self.counters["files"] / checksums if checksums else 0.0,
+            "hashed_bytes_per_second": self.counters["hashed_bytes"] / checksums if checksums else 0.0,
+            "worker_utilisation": hashing / checksums / config.parallel if checksums else 0.0,
+        }
+
+    def log_summary(self, config):
+        logger.info("%-16s %10s %12s %12s %12s" % ("stage", "count", "total s", "mean ms", "max ms"))
+        for stage, (count, total, maximum) in self.stages.items():
+            logger.info("%-16s %10d %12.3f %12.3f %12.3f" % (stage, count, total, 1000 * total / count, 1000 * maximum))
+
+        throughput = self.throughput(config)
+        logger.info(
+            "%d files, %d bytes hashed in %.1f s: %.1f files/s, %.1f MB/s hashed, %.0f%% hash worker utilisation"
+            % (
+                self.counters["files"],
+                self.counters["hashed_bytes"],
+                throughput["elapsed_seconds"],
+                throughput["files_per_second"],
+                throughput["hashed_bytes_per_second"] / 1e6,
+                100 * throughput["worker_utilisation"],
+            )
+        )
+
+    def write(self, path, config):
+        throughput = self.throughput(config)
+
+        if path.endswith(".json"):
+            content = json.dumps(
+                {
+                    "source": config.source,
+                    "target": config.target,
+                    "stages": {
+                        stage: {"count": count, "total_seconds": total, "max_seconds": maximum}
+                        for stage, (count, total, maximum) in self.stages.items()
+                    },
+                    "counters": dict(self.counters),
+                    "throughput": throughput,
+                },
+                indent=2,
+            )
+        else:
+            target = config.target.replace("\\", "\\\\").replace('"', '\\"')
+            lines = list()
+            for name, kind, values in (
+                ("stage_seconds_total", "counter", {stage: v[1] for stage, v in self.stages.items()}),
+                ("stage_count_total", "counter", {stage: v[0] for stage, v in self.stages.items()}),
+                ("stage_max_seconds", "gauge", {stage: v[2] for stage, v in self.stages.items()}),
+            ):
+                lines.append("# TYPE %s_%s %s" % (self.PREFIX, name, kind))
+                for stage, value in values.items():
+                    lines.append('%s_%s{target="%s",stage="%s"} %s' % (self.PREFIX, name, target, stage, value))
+            for name, value in list(self.counters.items()) + list(throughput.items()):
+                lines.append("# TYPE %s_%s gauge" % (self.PREFIX, name))
+                lines.append('%s_%s{target="%s"} %s' % (self.PREFIX, name, target, value))
+            content = "\n".join(lines)
+
+        # Replace the file at once, a textfile collector might be reading it
+        with open(path + ".tmp", "w") as f:
+            f.write(content + "\n")
+        os.replace(path + ".tmp", path)
+
+
+class Checkpoint:
+    """
+    Outcomes of the files verified so far, to resume an interrupted validation. Like in the checksum cache, an outcome
+    is only valid as long as the size, modification time and inode of the file are unchanged. The outcomes depend on
+    the target, --all-replicas and --algorithms, so these are recorded and a resume with other ones is refused.
+    """
+
+    # Seconds after which the checkpoint is committed to disk
+    COMMIT_INTERVAL = 10
+
+    def __init__(self, config):
+        self.connection = sqlite3.connect(config.checkpoint)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS outcomes "
+            "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, outcome TEXT, resources TEXT)"
+        )
+        self.connection.execute("CREATE TABLE IF NOT EXISTS parameters (name TEXT PRIMARY KEY, value TEXT)")
+
+        parameters = {
+            "target": config.target.rstrip("/"),
+            "all_replicas": str(bool(config.all_replicas)),
+            "algorithms": " ".join(sorted(config.algorithms)),
+        }
+        if config.resume:
+            recorded = dict(self.connection.execute("SELECT name, value FROM parameters"))
+            if recorded != parameters:
+                self.connection.close()
+                recorded = ", ".join("%s=%s" % item for item in sorted(recorded.items())) or "none recorded"
+                raise ValueError("Checkpoint `%s` was made for another validation (%s)" % (config.checkpoint, recorded))
+        else:
+            self.connection.execute("DELETE FROM outcomes")
+            self.connection.execute("DELETE FROM parameters")
+            self.connection.executemany("INSERT INTO parameters (name, value) VALUES (?, ?)", parameters.items())
+        self.connection.commit()
+        self.resumed = 0
+        self.last_commit = time.monotonic()
+
+    def get(self, source_file):
+        """
+        Returns the outcome and the (resource, outcome) pairs of the replicas that failed, or None when not verified
+        yet
+        """
+        row = self.connection.execute(
+            "SELECT outcome, resources FROM outcomes WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+            source_file,
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        self.resumed += 1
+        return row[0], tuple(tuple(failure.rsplit(":", 1)) for failure in row[1].split(" ")) if row[1] else ()
+
+    def put(self, source_file, outcome, failures):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO outcomes (path, size, mtime_ns, inode, outcome, resources) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            source_file + (outcome, " ".join("%s:%s" % failure for failure in failures)),
+        )
+
+        if time.monotonic() - self.last_commit >= self.COMMIT_INTERVAL:
+            self.connection.commit()
+            self.last_commit = time.monotonic()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
 
 
 def irods_session(config):
@@ -97,109 +763,811 @@ def irods_session(config):
     return session
 
 
-def irods_hash_to_sha256(h):
-    irods_hash = h.split("sha2:")[1]
-    base_hash = base64.b64decode(irods_hash)
-    return binascii.hexlify(base_hash).decode("utf-8")
+def irods_catalog_index(session, config):
+    """
+    List all data objects under the target collection with one streamed GenQuery and index them by path
+    relative to the target. Of multiple replicas, the size and checksum of the one with the lowest replica number
+    are kept, and with --all-replicas the storage resource and checksum of every replica.
+    """
+    target = config.target.rstrip("/")
+    columns = (
+        Collection.name,
+        DataObject.name,
+        DataObject.size,
+        DataObject.checksum,
+        DataObject.replica_number,
+        DataObject.resc_hier,
+    )
 
+    # The target collection itself and everything below it. The LIKE pattern may over-match when the
+    # target contains wildcard characters, hence the prefix check on each row.
+    queries = [
+        session.query(*columns).filter(Collection.name == target),
+        session.query(*columns).filter(Like(Collection.name, target + "/%")),
+    ]
 
-def main():
-    config = parse_arguments()
+    progress = tqdm(unit="objects", unit_scale=True, disable=config.quiet)
+    index = dict()
+    for query in queries:
+        for row in query:
+            coll_name = row[Collection.name]
+            if coll_name == target:
+                rel_path = row[DataObject.name]
+            elif coll_name.startswith(target + "/"):
+                rel_path = posixpath.join(coll_name[len(target) + 1 :], row[DataObject.name])
+            else:
+                continue
 
-    # Change requested log level
-    if config.quiet:
-        logger.setLevel(logging.ERROR)
-    if config.verbose:
-        logger.setLevel(logging.DEBUG)
+            # The storage resource of the replica is the leaf of its resource hierarchy
+            resource = row[DataObject.resc_hier].rsplit(";", 1)[-1]
+            replicas = ((resource, row[DataObject.checksum]),) if config.all_replicas else None
+            entry = CatalogEntry(
+                row[DataObject.size], row[DataObject.checksum], row[DataObject.replica_number], replicas
+            )
 
-    # iRODS connection
-    session = irods_session(config)
-    if session is None:
-        return 1
+            known = index.get(rel_path)
+            if known is None:
+                progress.update(1)
+            elif config.all_replicas:
+                replicas = known.replicas + replicas
+                if known.replica_number < entry.replica_number:
+                    entry = known
+                entry = entry._replace(replicas=replicas)
+            elif known.replica_number < entry.replica_number:
+                continue
+            index[rel_path] = entry
+    progress.close()
 
-    # Multiprocessing pool and result list
-    pool = Pool(processes=config.parallel)
-    results = list()
+    return index
 
-    # Setup inventory progress
-    logger.info("Making inventory of source directory '%s'" % config.source)
-    progress_inv = tqdm(unit="files", unit_scale=True, disable=config.quiet)
 
-    # Fill input queue with the source directory
-    total_bytes = 0
-    for root, dirs, files in os.walk(config.source, topdown=False):
-        for name in files:
-            os_path = os.path.join(root, name)
-            rel_path = os.path.relpath(os_path, config.source)
+class SessionPool:
+    """
+    A fixed number of iRODS sessions with a thread pool in front, to run catalog lookups concurrently. There are as
+    many threads as sessions, so every running lookup has a session of its own and no more lookups than sessions
+    are in flight.
+    """
 
-            results.append(pool.apply_async(checksum_calculator, args=(config, rel_path)))
-            progress_inv.update(1)
+    def __init__(self, sessions):
+        self.sessions = queue.Queue()
+        for session in sessions:
+            self.sessions.put(session)
+        self.executor = ThreadPoolExecutor(max_workers=len(sessions))
 
-            # Byte size
-            stat = os.stat(os_path)
-            total_bytes += stat.st_size
+    @classmethod
+    def connect(cls, config, size):
+        """Open `size` sessions. Returns None when a connection fails."""
+        sessions = list()
+        for _ in range(size):
+            session = irods_session(config)
+            if session is None:
+                for s in sessions:
+                    s.cleanup()
+                return None
+            sessions.append(session)
 
-    # Finish inventory
-    progress_inv.close()
-    logger.info("Validating %d files and %d bytes in source directory." % (len(results), total_bytes))
+        return cls(sessions)
+
+    def submit(self, fn, *args):
+        """Run fn(session, *args) on a free session, returns a Future"""
+        return self.executor.submit(self._run, fn, *args)
+
+    def _run(self, fn, *args):
+        session = self.sessions.get()
+        try:
+            return fn(session, *args)
+        finally:
+            self.sessions.put(session)
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        while not self.sessions.empty():
+            self.sessions.get().cleanup()
 
-    # Setup progress
-    progress_bytes = tqdm(unit="bytes", unit_scale=True, total=total_bytes, disable=config.quiet, position=0)
-    progress_files = tqdm(unit="files", unit_scale=True, total=len(results), disable=config.quiet, position=1)
 
-    # Loop through results and check with iRODS
+def irods_lookup_checksum(session, config, p):
+    """
+    Return the checksum iRODS has stored for `p` with a lookup of the data object. Raises DataObjectDoesNotExist
+    when the object is not in the target.
+    """
+    total_p = os.path.join(config.target, p)
     try:
-        for result in results:
-            # Wait for result worker to finish
-            p, size, checksum = result.get()
+        o = session.data_objects.get(total_p)
+    except CollectionDoesNotExist:
+        raise DataObjectDoesNotExist()
+    return o.checksum
 
-            # Update progress bar
-            progress_bytes.update(size)
-            progress_files.update(1)
 
-            # Get iRODS object
-            total_p = os.path.join(config.target, p)
-            try:
-                o = session.data_objects.get(total_p)
-            except (CollectionDoesNotExist, DataObjectDoesNotExist):
-                logger.error("File `%s` does not exist in target collection" % p)
+def irods_checksum_to_hex(h):
+    """
+    Algorithm and hex digest of a checksum stored in iRODS: "sha2:" followed by the base64 encoded sha256, or the
+    plain hex md5 of older collections. Returns (None, None) for anything else.
+    """
+    if h.startswith("sha2:"):
+        try:
+            return "sha256", binascii.hexlify(base64.b64decode(h[len("sha2:") :], validate=True)).decode("utf-8")
+        except binascii.Error:
+            return None, None
+
+    if len(h) == 32 and all(c in "0123456789abcdefABCDEF" for c in h):
+        return "md5", h.lower()
+
+    return None, None
+
+
+def required_algorithms(catalog, config, p, irods_checksum=None):
+    """Algorithms of the iRODS checksums of a file, of the ones selected with --algorithms"""
+    if catalog is None:
+        checksums = (irods_checksum,)
+    elif p not in catalog:
+        checksums = ()
+    elif config.all_replicas:
+        checksums = tuple(checksum for _, checksum in catalog[p].replicas)
+    else:
+        checksums = (catalog[p].checksum,)
+
+    used = {irods_checksum_to_hex(checksum)[0] for checksum in checksums if checksum}
+    return tuple(algorithm for algorithm in config.algorithms if algorithm in used)
+
+
+def compare_checksum(irods_checksum, digests):
+    """Outcome of comparing one checksum stored in iRODS with the local digests"""
+    algorithm, irods_digest = irods_checksum_to_hex(irods_checksum)
+    if algorithm not in digests:
+        return "unsupported-checksum"
+    if irods_digest != digests[algorithm]:
+        return "checksum-mismatch"
+    return OK
+
+
+def verify_checksum(catalog, config, p, digests, irods_checksum=None):
+    """
+    Check the locally calculated digests against iRODS, using the catalog index when there is one, or else the
+    checksum looked up for the file. Returns the outcome, see OUTCOME_MESSAGES, and the (resource, outcome) pairs of
+    the replicas that failed when all replicas are verified.
+    """
+    if config.all_replicas:
+        return verify_replica_checksums(catalog, p, digests)
+
+    # Get iRODS checksum
+    if catalog is not None:
+        entry = catalog.get(p)
+        if entry is None:
+            return "missing", ()
+        irods_checksum = entry.checksum
+
+    # Check whether iRODS has a checksum stored
+    if not irods_checksum:
+        return "no-checksum", ()
+
+    # Check checksum, with the digest of the algorithm the iRODS checksum was calculated with
+    return compare_checksum(irods_checksum, digests), ()
+
+
+def verify_replica_checksums(catalog, p, digests):
+    """
+    Check the locally calculated digests against every replica in the catalog index. Every failing replica is
+    returned with its own outcome, the outcome of the file is the most severe of them.
+    """
+    entry = catalog.get(p)
+    if entry is None:
+        return "missing", ()
+
+    outcomes = [
+        (resource, compare_checksum(irods_checksum, digests) if irods_checksum else "no-checksum")
+        for resource, irods_checksum in entry.replicas
+    ]
+    failures = tuple((resource, outcome) for resource, outcome in outcomes if outcome != OK)
+    for failure in ("checksum-mismatch", "no-checksum", "unsupported-checksum"):
+        if any(outcome == failure for _, outcome in failures):
+            return failure, failures
+
+    return OK, ()
+
+
+def scan_directory(source, directory):
+    """
+    List a single directory. Returns the SourceFile of every file in it and the subdirectories to scan next.
+    Subdirectories are told apart by the type in the directory entry, so only files cost a stat call. A file that
+    cannot be stat'ed (e.g. a broken symbolic link) or a directory that cannot be listed is returned as a SourceFile
+    without size, the other entries of the directory are still returned.
+    """
+    files = list()
+    directories = list()
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    # Like os.walk, symbolic links to directories are not followed
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif not entry.is_dir():
+                        stat = entry.stat()
+                        files.append(
+                            SourceFile(os.path.relpath(entry.path, source), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+                        )
+                except OSError as e:
+                    logger.debug("Cannot stat '%s': %s" % (entry.path, e))
+                    files.append(SourceFile(os.path.relpath(entry.path, source), None, None, None))
+    except OSError as e:
+        logger.debug("Cannot list directory '%s': %s" % (directory, e))
+        files.append(SourceFile(os.path.relpath(directory, source), None, None, None))
+
+    return files, directories
+
+
+def walk_source(config):
+    """
+    Generate a SourceFile for every file in the source directory. Directories are listed by config.scan_threads
+    threads at once, as on network mounts every listing and stat is a round trip that mostly waits on the server.
+    Files are generated as soon as their directory is listed, in no particular order.
+    """
+    with ThreadPoolExecutor(max_workers=max(config.scan_threads, 1)) as executor:
+        pending = {executor.submit(scan_directory, config.source, config.source)}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, directories = future.result()
+                    pending.update(executor.submit(scan_directory, config.source, d) for d in directories)
+                    yield from files
+        finally:
+            # Stopped before the end of the walk
+            for future in pending:
+                future.cancel()
+
+
+class InotifyWatcher:
+    """
+    Recursive inotify watch of a directory, through the libc of the system. Reports files that were closed after
+    writing or moved into the watched tree, and new directories.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, root):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+        self.directories = dict()
+        for directory, dirs, files in os.walk(root):
+            self.add(directory)
 
-                if not getattr(config, "continue"):
-                    return 1
+    def add(self, directory):
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            # Directory is gone again, or the watch limit (fs.inotify.max_user_watches) is reached
+            logger.warning("Cannot watch directory '%s': %s" % (directory, os.strerror(ctypes.get_errno())))
+            return
+        self.directories[wd] = directory
+
+    def wait(self, timeout):
+        """
+        Wait at most timeout seconds for events. Returns a list of ("file", os_path), ("directory", os_path) and
+        ("overflow", None) events. After an overflow events were lost.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        buffer = os.read(self.fd, 64 * 1024)
+        events = list()
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = self.EVENT.unpack_from(buffer, offset)
+            name = os.fsdecode(buffer[offset + self.EVENT.size : offset + self.EVENT.size + length].rstrip(b"\0"))
+            offset += self.EVENT.size + length
+
+            if mask & self.IN_Q_OVERFLOW:
+                events.append(("overflow", None))
+            elif wd in self.directories:
+                os_path = os.path.join(self.directories[wd], name)
+                if mask & self.IN_ISDIR:
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        events.append(("directory", os_path))
+                elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                    events.append(("file", os_path))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Fallback of the InotifyWatcher, reports nothing and leaves it to the periodic walk of the source directory"""
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return []
+
+    def close(self):
+        pass
+
+
+def watch_source(config):
+    """
+    Hash files in the source directory as they land and store their checksums in the checksum cache, so the
+    validation after ingest only has to hash files that changed since or were never hashed. With inotify a file is
+    hashed as soon as it is closed after writing, files that were already there or were missed are hashed once their
+    size and modification time have been unchanged for --watch-interval seconds. Without inotify the source
+    directory is walked every --watch-interval seconds instead. Runs until interrupted, returns the exit code.
+    """
+    watcher = None
+    if not config.polling:
+        try:
+            watcher = InotifyWatcher(config.source)
+        except (OSError, AttributeError) as e:
+            logger.warning("Cannot use inotify, polling the source directory instead: %s" % e)
+    if watcher is None:
+        watcher = PollingWatcher()
+
+    logger.info(
+        "Watching source directory '%s' with %s"
+        % (config.source, "polling" if isinstance(watcher, PollingWatcher) else "inotify")
+    )
+
+    cache = ChecksumCache(config.cache)
+    pool = hash_pool(config)
+    results = queue.Queue()
+
+    # Stop on a plain kill as well, set after the pool is started so the hash workers keep the default handler
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    # Files that were hashed in this run and files waiting to be unchanged for an interval, by relative path
+    hashed = dict()
+    pending = dict()
+    in_flight = set()
+
+    def stat(os_path):
+        try:
+            st = os.stat(os_path)
+        except FileNotFoundError:
+            return None
+        return SourceFile(os.path.relpath(os_path, config.source), st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def start_hashing(source_file):
+        pending.pop(source_file.path, None)
+        if source_file.path in in_flight:
+            # Changed while being hashed, checked again once the running hash is done
+            return
+        in_flight.add(source_file.path)
+        pool.apply_async(
+            checksum_calculator,
+            args=(source_file.path, config.algorithms),
+            callback=lambda result: results.put((source_file, result)),
+            error_callback=lambda e: results.put((source_file, e)),
+        )
+
+    def settle(source_file):
+        """Hash the file when it is unchanged since it was last seen"""
+        if hashed.get(source_file.path) == source_file:
+            return
+        if source_file.path not in pending and cache.get(source_file, config.algorithms) is not None:
+            hashed[source_file.path] = source_file
+            return
+        if pending.get(source_file.path) == source_file:
+            start_hashing(source_file)
+        else:
+            pending[source_file.path] = source_file
+
+    def scan(directory):
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                source_file = stat(os.path.join(root, name))
+                if source_file is not None:
+                    settle(source_file)
+
+    try:
+        scan(config.source)
+        last_tick = time.monotonic()
+        while True:
+            for kind, os_path in watcher.wait(1):
+                if kind == "file":
+                    source_file = stat(os_path)
+                    if source_file is not None and hashed.get(source_file.path) != source_file:
+                        start_hashing(source_file)
+                elif kind == "directory":
+                    # Files may have landed in the new directory before it was watched
+                    for directory, dirs, files in os.walk(os_path):
+                        watcher.add(directory)
+                    scan(os_path)
                 else:
+                    logger.warning("Missed inotify events, walking source directory again")
+                    scan(config.source)
+
+            while not results.empty():
+                source_file, result = results.get()
+                in_flight.discard(source_file.path)
+                if isinstance(result, Exception):
+                    logger.debug("Cannot hash %s: %s" % (source_file.path, result))
                     continue
 
-            # Check whether iRODS has a checksum stored
-            if o.checksum is None:
-                logger.error("File `%s` does not have a checksum stored in iRODS" % p)
+                current = stat(os.path.join(config.source, source_file.path))
+                if current == source_file:
+                    cache.put(source_file, result[2])
+                    hashed[source_file.path] = source_file
+                    logger.debug("Hashed %s" % source_file.path)
+                elif current is not None:
+                    # Written to while hashing
+                    pending[current.path] = current
 
-                if not getattr(config, "continue"):
-                    return 1
+            if time.monotonic() - last_tick >= config.watch_interval:
+                last_tick = time.monotonic()
+                if isinstance(watcher, PollingWatcher):
+                    scan(config.source)
                 else:
-                    continue
+                    for source_file in list(pending.values()):
+                        current = stat(os.path.join(config.source, source_file.path))
+                        if current is None:
+                            del pending[source_file.path]
+                        else:
+                            settle(current)
+                cache.connection.commit()
+                logger.info(
+                    "Watching: %d files hashed, %d hashing, %d pending" % (len(hashed), len(in_flight), len(pending))
+                )
+    except KeyboardInterrupt:
+        logger.info("Stopped watching: %d files hashed, %d not complete" % (len(hashed), len(in_flight) + len(pending)))
+    finally:
+        pool.terminate()
+        pool.join()
+        watcher.close()
+        cache.close()
+
+    return 0
 
-            # Convert checksum
-            irods_hash_decode = irods_hash_to_sha256(o.checksum)
 
-            # Check checksum
-            if irods_hash_decode != checksum:
-                logger.error("File `%s` does not match checksum" % p)
+def source_walker(files, events, slots, stop, metrics):
+    """
+    Post a ("file", source_file) event for every file. A slot is taken for every file, so the walker never runs
+    more than the number of slots ahead of the verification.
+    """
+    try:
+        files = iter(files)
+        while True:
+            with metrics.timer("walk"):
+                source_file = next(files, None)
+            if source_file is None:
+                break
+
+            while not slots.acquire(timeout=0.5):
+                if stop.is_set():
+                    return
+            if stop.is_set():
+                return
 
-                if not getattr(config, "continue"):
-                    return 1
+            events.put(("file", source_file))
+    except Exception as e:
+        events.put(("error", e))
+        return
+
+    events.put(("walked", None))
+
+
+def size_check(catalog, report, config, metrics):
+    """
+    Compare the set of files in the source directory with the catalog index, before reading any data. Reports files
+    that are missing in iRODS, have another size than DATA_SIZE or no checksum to verify against, and data objects
+    without a local counterpart. Returns the files that passed and the number of errors.
+    """
+    logger.info("Making inventory of source directory '%s'" % config.source)
+    progress_inv = tqdm(unit="files", unit_scale=True, disable=config.quiet)
+
+    passed = list()
+    seen = set()
+    unreadable = list()
+    errors = 0
+    start = time.monotonic()
+    for source_file in walk_source(config):
+        progress_inv.update(1)
+        seen.add(source_file.path)
+
+        entry = catalog.get(source_file.path)
+        if source_file.size is None:
+            report.add("unreadable", source_file.path)
+            unreadable.append(source_file.path)
+        elif entry is None:
+            report.add("missing", source_file.path, source_file.size)
+        elif entry.size != source_file.size:
+            report.add("size-mismatch", source_file.path, source_file.size, entry.size)
+        elif not (entry.checksum or config.all_replicas and any(checksum for _, checksum in entry.replicas)):
+            # No use in reading a file that cannot be verified
+            report.add("no-checksum", source_file.path, source_file.size, entry.size)
+        else:
+            passed.append(source_file)
+            if config.quick:
+                report.add(OK, source_file.path)
+            continue
+
+        errors += 1
+    progress_inv.close()
+    metrics.observe("inventory", time.monotonic() - start)
+
+    # Data objects in iRODS that are not in the source directory. The contents of a directory that cannot be listed
+    # are unknown, that directory is reported already.
+    prefixes = tuple("" if p == os.curdir else p + os.sep for p in unreadable)
+    for p in sorted(catalog.keys() - seen):
+        if not p.startswith(prefixes):
+            report.add(EXTRA, p, None, catalog[p].size)
+
+    logger.info("Size check: %d files passed, %d errors" % (len(passed), errors))
+
+    return passed, errors
+
+
+def validate_checksums(catalog, report, config, files, metrics):
+    """Calculate the checksum of the files and verify them against iRODS. Returns the exit code."""
+    # Outcomes of verified files, either read back from the checkpoint or recorded in it
+    checkpoint = None
+    if config.checkpoint:
+        try:
+            checkpoint = Checkpoint(config)
+        except ValueError as e:
+            logger.error(e)
+            return 1
+
+    # Without a catalog index every file is looked up, concurrently on a pool of sessions
+    lookups = None
+    if catalog is None:
+        lookups = SessionPool.connect(config, config.connections)
+        if lookups is None:
+            if checkpoint is not None:
+                checkpoint.close()
+            return 1
+
+    # Local checksum cache
+    cache = None
+    if config.cache:
+        cache = ChecksumCache(config.cache)
+
+    # Pool of hash workers. The walker, the lookups, the hash workers and the verification below all post their
+    # events in one queue. The number of files between being found and being verified is bounded by the slots.
+    pool = hash_pool(config)
+    events = queue.Queue()
+    slots = threading.BoundedSemaphore(config.parallel * QUEUE_SIZE_PER_WORKER)
+    stop = threading.Event()
+
+    def start_lookup(source_file):
+        def lookup(session):
+            with metrics.timer("lookup"):
+                return irods_lookup_checksum(session, config, source_file.path)
+
+        def done(future):
+            try:
+                events.put(("looked-up", source_file, future.result()))
+            except DataObjectDoesNotExist as e:
+                events.put(("looked-up", source_file, e))
+            except Exception as e:
+                events.put(("error", e))
+
+        lookups.submit(lookup).add_done_callback(done)
+
+    def start_hashing(source_file, irods_checksum):
+        # Only hash files that are not in the cache, returns the digests right away for the ones that are. A file
+        # without any iRODS checksum of a selected algorithm is not read at all.
+        algorithms = required_algorithms(catalog, config, source_file.path, irods_checksum)
+        if not algorithms:
+            return dict()
+
+        digests = cache.get(source_file, algorithms) if cache is not None else None
+        if digests is None:
+            submitted = time.monotonic()
+            pool.apply_async(
+                checksum_calculator,
+                args=(source_file.path, algorithms),
+                callback=lambda result: events.put(("hashed", source_file, irods_checksum, result, submitted)),
+                error_callback=lambda e: events.put(("error", e)),
+            )
+        return digests
+
+    # Setup progress, the totals grow while the files are being walked
+    progress_bytes = tqdm(unit="bytes", unit_scale=True, total=0, disable=config.quiet, position=0)
+    progress_files = tqdm(unit="files", unit_scale=True, total=0, disable=config.quiet, position=1)
+
+    walker = threading.Thread(target=source_walker, args=(files, events, slots, stop, metrics), daemon=True)
+    walker.start()
+    start = time.monotonic()
+
+    # Handle events until the walk is done and every file found has been verified
+    walking = True
+    in_flight = 0
+    total_files = 0
+    total_bytes = 0
+    try:
+        while walking or in_flight:
+            event = events.get()
+
+            if event[0] == "error":
+                raise event[1]
+
+            if event[0] == "walked":
+                walking = False
+                continue
+
+            outcome = None
+            resumed = False
+            irods_checksum = None
+            if event[0] == "file":
+                source_file = event[1]
+                total_files += 1
+                total_bytes += source_file.size or 0
+                progress_files.total = total_files
+                progress_bytes.total = total_bytes
+
+                if source_file.size is None:
+                    outcome, failures = "unreadable", ()
+                # Files that were verified before the validation got interrupted keep their outcome
+                elif config.resume:
+                    outcome, failures = checkpoint.get(source_file) or (None, ())
+                    resumed = outcome is not None
+
+                if outcome is None:
+                    # Look the file up first, there is no use in hashing a file that cannot be verified
+                    if lookups is not None:
+                        start_lookup(source_file)
+                        in_flight += 1
+                        continue
+
+                    digests = start_hashing(source_file, None)
+                    if digests is None:
+                        in_flight += 1
+                        continue
+
+            elif event[0] == "looked-up":
+                in_flight -= 1
+                source_file, irods_checksum = event[1], event[2]
+
+                if isinstance(irods_checksum, DataObjectDoesNotExist):
+                    outcome, failures = "missing", ()
+                elif not irods_checksum:
+                    outcome, failures = "no-checksum", ()
                 else:
-                    continue
+                    digests = start_hashing(source_file, irods_checksum)
+                    if digests is None:
+                        in_flight += 1
+                        continue
+
+            else:
+                # Result of a hash worker
+                in_flight -= 1
+                source_file, irods_checksum, submitted = event[1], event[2], event[4]
+                p, size, digests, started, duration = event[3]
+                metrics.observe("queue_wait", started - submitted)
+                metrics.observe("hash", duration)
+                metrics.count("hashed_files")
+                metrics.count("hashed_bytes", size)
+
+                # Remember freshly calculated checksums, unless the file changed while hashing
+                if cache is not None and size == source_file.size:
+                    cache.put(source_file, digests)
+
+            # This file is done, let the walker continue
+            slots.release()
+
+            # Update progress bar
+            progress_bytes.update(source_file.size or 0)
+            progress_files.update(1)
+
+            p = source_file.path
+            with metrics.timer("verify"):
+                if outcome is None:
+                    outcome, failures = verify_checksum(catalog, config, p, digests, irods_checksum)
+                if checkpoint is not None and not resumed and source_file.size is not None:
+                    checkpoint.put(source_file, outcome, failures)
+
+                irods_size = catalog[p].size if catalog is not None and p in catalog else None
+                report.add(outcome, p, source_file.size, irods_size, failures)
+            metrics.count("files")
+            metrics.count("bytes", source_file.size or 0)
+            if outcome != OK and not getattr(config, "continue"):
+                return 1
 
     except KeyboardInterrupt:
         # The finally block is executed always, but the KeyboardInterrupt needs to be reraised to be handled by parent
         raise KeyboardInterrupt
     finally:
-        # Terminate worker and progress bar
+        # Stop walker, terminate worker and progress bar
+        metrics.observe("checksums", time.monotonic() - start)
+        stop.set()
         pool.terminate()
         pool.join()
         progress_bytes.close()
         progress_files.close()
+
+        if lookups is not None:
+            lookups.close()
+
+        if cache is not None:
+            cache.close()
+            logger.info("Checksum cache: %d hits, %d misses" % (cache.hits, cache.misses))
+
+        if checkpoint is not None:
+            checkpoint.close()
+            if config.resume:
+                logger.info("Resumed %d files from checkpoint" % checkpoint.resumed)
+
+    logger.info("Finished checksum validation of %d files and %d bytes" % (total_files, total_bytes))
+
+    return 0
+
+
+def main():
+    config = parse_arguments()
+
+    # Change requested log level
+    if config.quiet:
+        logger.setLevel(logging.ERROR)
+    if config.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    # Watch mode only fills the checksum cache, it does not need iRODS
+    if config.watch:
+        return watch_source(config)
+
+    # iRODS connection
+    session = irods_session(config)
+    if session is None:
+        return 1
+
+    report = Report(config)
+    metrics = Metrics()
+    try:
+        # Bulk listing of the target collection, the size check always needs it
+        catalog = None
+        if config.prefetch or config.all_replicas or config.quick or not config.skip_size_check:
+            logger.info("Listing data objects in target collection '%s'" % config.target)
+            with metrics.timer("catalog_listing"):
+                catalog = irods_catalog_index(session, config)
+            logger.info("Found %d data objects in target collection." % len(catalog))
+
+        # First phase: existence and size of all files, before reading any data
+        if config.quick or not config.skip_size_check:
+            files, errors = size_check(catalog, report, config, metrics)
+
+            if errors and not getattr(config, "continue"):
+                return 1
+            if config.quick:
+                logger.info("Finished quick validation")
+                return 0
+
+            if config.sample is not None:
+                passed = files
+                files = sample_files(passed, config)
+                logger.info("Sampled %d of %d files with seed '%s'" % (len(files), len(passed), config.seed))
+                before = report.counts.copy()
+
+            files = schedule_files(files, config)
+        else:
+            # Without the inventory of the size check the files can only be hashed in the order they are found
+            files = walk_source(config)
+
+        # Second phase: checksums
+        logger.info("Validating checksums of source directory '%s'" % config.source)
+        exit_code = validate_checksums(catalog, report, config, files, metrics)
+        if config.sample is not None:
+            log_sample_summary(passed, files, report.counts - before)
+        if exit_code != 0:
+            return 1
+    finally:
         session.cleanup()
+        report.close()
+        logger.info("Validation summary: %s" % report.summary())
+        if report.resource_counts:
+            logger.info("Replica failures per resource: %s" % report.resource_summary())
+
+        metrics.log_summary(config)
+        if config.metrics:
+            metrics.write(config.metrics, config)
 
     logger.info("Finished validation")
 
@@ -4,7 +4,18 @@ import os
 import sys
 import logging
 import argparse
-from collections import defaultdict
+import json
+import re
+import sqlite3
+import time
+import uuid
+from calendar import timegm
+from contextlib import closing, contextmanager
+from collections import defaultdict, namedtuple
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from functools import partial
 from irods.session import iRODSSession
 from irods.models import Collection, CollectionMeta, User, UserMeta, Resource, DataObject
 from irods.column import Criterion, In
@@ -50,6 +61,53 @@ USERS_AVU_LIST = [
     'eduPersonUniqueID',
 ]
 
+# AVUs of project collections holding their size in bytes and number of data objects (see irodsRecalcProjectCollSizes)
+SIZE_AVU = 'dcat:byteSize'
+NUM_FILES_AVU = 'numFiles'
+
+# Maximum number of data objects listed by name per finding of the checksum audit, all are counted
+AUDIT_LIST_LIMIT = 100
+
+# Value types of the rules (see --rules), as regular expressions matching the whole value
+VALUE_TYPES = {
+    'int': r'-?[0-9]+',
+    'number': r'-?[0-9]+(\.[0-9]+)?',
+    'bool': r'true|false',
+    'date': r'[0-9]{4}-[0-9]{2}-[0-9]{2}',
+}
+
+# Compiled rules of one kind of object: the attribute names in rule order, the required ones, and the
+# attribute name -> compiled pattern of the attributes whose values are checked
+AvuCheck = namedtuple('AvuCheck', ['label', 'plural', 'avu_names', 'required', 'irods_obj_type', 'obj_name_like',
+                                   'not_like', 'value_patterns'])
+
+# Number of names or ids per `In` condition, when querying a set of objects in chunks
+IN_CHUNK_SIZE = 100
+
+# Seconds the watermark of an incremental run is moved back, to not miss changes made while the
+# previous run was going on, or hidden by a clock difference with the iCAT server
+WATERMARK_OVERLAP = 300
+
+# Tables of a catalog snapshot (--export-snapshot), modify times are seconds since the epoch.
+# objects: the projects, project collections and users; avus: their metadata; replicas: one row per data object replica
+SNAPSHOT_SCHEMA = """
+CREATE TABLE snapshot (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE objects (type TEXT, name TEXT, user_type TEXT, modify_time INTEGER, PRIMARY KEY (type, name));
+CREATE TABLE avus (type TEXT, name TEXT, attribute TEXT, value TEXT, units TEXT, modify_time INTEGER);
+CREATE TABLE resources (id INTEGER PRIMARY KEY, name TEXT, type TEXT, parent TEXT);
+CREATE TABLE replicas (data_id INTEGER, coll_name TEXT, data_name TEXT, replica_number INTEGER, resc_id INTEGER,
+                       size INTEGER, checksum TEXT, modify_time INTEGER);
+"""
+
+# Created after loading the snapshot, which is faster than updating them on every insert
+SNAPSHOT_INDEXES = """
+CREATE INDEX avus_object ON avus (type, name, attribute);
+CREATE INDEX avus_attribute ON avus (attribute);
+CREATE INDEX replicas_data_id ON replicas (data_id);
+CREATE INDEX replicas_coll_name ON replicas (coll_name);
+CREATE INDEX replicas_resc_id ON replicas (resc_id);
+"""
+
 # resources on which replicas of data objects will be checked for (counted):
 # NOTE: ONLY APPLIES IF AUTO_REPL_RESC is False
 AUTO_REPL_RESC = True
@@ -67,8 +125,35 @@ def parse_args():
     #parser.add_argument("-H", "--host", default=None, action='store', required=False, type=str)
     parser.add_argument("-e", "--env-file", default=None, action='store',
                         required=False, type=str, help="Path to irods environment file containing connection settings.")
+    parser.add_argument("--sql", default=False, action='store_true',
+                        help="Run the checks as SQL in the iCAT database (SpecificQuery, needs rodsadmin).")
+    parser.add_argument("-s", "--state", default=None, action='store', required=False, type=str,
+                        help="State file with the watermark and findings of the last run. When it exists, only "
+                             "objects changed since the last run are checked.")
+    parser.add_argument("--full", default=False, action='store_true',
+                        help="Check all objects and rebuild the state file, instead of an incremental run.")
+    parser.add_argument("--check-sizes", default=False, action='store_true',
+                        help="Also check the stored sizes and numbers of files of all project collections.")
+    parser.add_argument("--audit-checksums", default=False, action='store_true',
+                        help="Also audit the checksums of all replicas in the zone: missing and differing checksums.")
+    parser.add_argument("-r", "--rules", default=None, action='store', metavar="FILE",
+                        help="JSON file with the expected AVUs and their values, instead of the built-in lists.")
+    parser.add_argument("--export-snapshot", default=None, action='store', metavar="FILE",
+                        help="Export the objects checked by the rules, their AVUs, the resources and all replicas "
+                             "into an SQLite snapshot FILE, instead of checking.")
+    parser.add_argument("--snapshot", default=None, action='store', metavar="FILE",
+                        help="Run the checks offline against a snapshot FILE, exported for the same rules, instead "
+                             "of iRODS.")
+    parser.add_argument("-j", "--jobs", default=4, action='store', type=int,
+                        help="Number of checks running concurrently, each on its own iRODS session.")
+    parser.add_argument("-t", "--timeout", default=None, action='store', type=int,
+                        help="Seconds after which a single check is given up, and the limit of every iRODS call.")
+
+    args = parser.parse_args()
+    if args.snapshot and (args.state or args.export_snapshot):
+        parser.error("--snapshot cannot be combined with --state or --export-snapshot")
 
-    return parser.parse_args()
+    return args
 
 
 # Skeleton (logging, irods_session) based on: irodsDropzoneValidator.py
@@ -103,80 +188,137 @@ def irods_session(env_file=None):
     return session
 
 
-def missing_avu_sql(session, avu_name, irods_obj_type, obj_name_like=None, not_like=False):
+# iRODS session of a single check, every iRODS call of it is bounded by `timeout` seconds
+@contextmanager
+def check_session(env_file=None, timeout=None):
+    session = irods_session(env_file)
+    if session is None:
+        raise Exception("Could not connect to iRODS")
+
+    with session:
+        if timeout:
+            session.connection_timeout = timeout
+        yield session
+
+
+# Read-only connection to a catalog snapshot
+@contextmanager
+def open_snapshot(snapshot_file):
+    with closing(sqlite3.connect(f"file:{os.path.abspath(snapshot_file)}?mode=ro", uri=True)) as db:
+        # LIKE patterns are case sensitive in the iCAT
+        db.execute("PRAGMA case_sensitive_like = ON")
+        yield db
+
+
+# Registers `sql` as a SpecificQuery under an alias that is unique to this run and call, so concurrent
+# housekeeping runs (or checks) never collide on an alias, and always removes it again afterwards.
+# `args` are bound to the `?` placeholders in `sql` by iRODS (at most 10), never interpolated into it.
+@contextmanager
+def specific_query(session, sql, columns, args=()):
+    alias = f"housekeeping_{uuid.uuid4().hex}"
+    log.debug(f"SQL QUERY {alias}:")
+    log.debug(sql)
+
+    if len(args) > 10:
+        raise ValueError("A SpecificQuery takes at most 10 arguments")
+
+    query = SpecificQuery(session, sql, alias, columns, list(args))
+    query.register()
+    try:
+        yield query
+    finally:
+        # Also after errors, a left-over query can only be removed with `iadmin rsq $alias`
+        try:
+            query.remove()
+        except Exception as e:
+            log.error(f"Could not remove SpecificQuery {alias}, remove it with `iadmin rsq {alias}`: {e}")
+
+
+# Returns, for every attribute name in avu_names, the list of objects that miss it.
+# The NOT EXISTS check for all attributes runs as one SQL statement in the iCAT database,
+# see: https://github.com/irods/irods/issues/2437 and ./README.md
+def missing_avus_sql(session, avu_names, irods_obj_type, obj_name_like=None, not_like=False):
     # depending on the iRODS object type, different tables/columns will be queried,
     # written out for the sake of explicitness
     if irods_obj_type == 'Collection':
         obj_table = 'r_coll_main'
-        obj_column_name =  'coll_name'
+        obj_column_name = 'coll_name'
         obj_column_id = 'coll_id'
         obj_model_name = Collection.name
+        obj_model_meta_name = CollectionMeta.name
     elif irods_obj_type == 'User':
         obj_table = 'r_user_main'
-        obj_column_name =  'user_name'
+        obj_column_name = 'user_name'
         obj_column_id = 'user_id'
         obj_model_name = User.name
+        obj_model_meta_name = UserMeta.name
     else:
         raise Exception("iRODS object type not supported.")
 
-    objs_found = list()
-    # We begin to hackily construct our SQL query
-    # See: https://github.com/irods/irods/issues/2437
-    #      And ./README.md
-    sql_name_constraint_and = ''
+    if not avu_names:
+        return {}
+
+    # The attribute names are passed as one argument and split in SQL, a SpecificQuery only takes 10 arguments
+    if any(',' in avu_name for avu_name in avu_names):
+        raise ValueError("Attribute names containing ',' are not supported.")
+
+    # Only the table and column names (from the fixed mapping above) are part of the SQL text,
+    # every value is a bind argument.
+    conditions = list()
+    args = [','.join(avu_names)]
     if obj_name_like:
-        sql_name_constraint_and = f"o1.{obj_column_name} {'not like' if not_like else 'like'} '{obj_name_like}' AND"
-    sql_only_user_type_and = ''
+        conditions.append(f"o.{obj_column_name} {'NOT LIKE' if not_like else 'LIKE'} ?")
+        args.append(obj_name_like)
     if irods_obj_type == 'User':
         # We are not interested in groups nor admins (?)
         # See: https://github.com/irods/python-irodsclient#listing-users-and-groups--calculating-group-membership
-        sql_only_user_type_and = "o1.user_type_name = 'rodsuser' AND"
-    sql = f"""
-    SELECT {obj_column_name}
-    FROM {obj_table} as o1
-    WHERE {sql_name_constraint_and} {sql_only_user_type_and}
-    NOT EXISTS (
+        conditions.append("o.user_type_name = ?")
+        args.append('rodsuser')
+
+    conditions.append(f"""NOT EXISTS (
         SELECT 1
-        FROM {obj_table} as o2
-        JOIN r_objt_metamap ON o2.{obj_column_id} = r_objt_metamap.object_id
+        FROM r_objt_metamap
         JOIN r_meta_main ON r_meta_main.meta_id = r_objt_metamap.meta_id
-        WHERE r_meta_main.meta_attr_name = '{avu_name}'
-        AND o1.{obj_column_id} = o2.{obj_column_id}
-    );
+        WHERE r_objt_metamap.object_id = o.{obj_column_id}
+        AND r_meta_main.meta_attr_name = a.attr_name
+    )""")
+
+    # Every object is paired with every expected attribute name, the pairs without a matching AVU remain
+    sql = f"""
+    SELECT o.{obj_column_name}, a.attr_name
+    FROM {obj_table} AS o
+    CROSS JOIN unnest(string_to_array(?, ',')) AS a(attr_name)
+    WHERE {' AND '.join(conditions)}
+    ORDER BY o.{obj_column_name}, a.attr_name
     """
-    log.debug("SQL QUERY:")
-    log.debug(sql)
-    # FIXME: concurrency! Will crash
-    alias = f'sql_missing_avu_{irods_obj_type}_{avu_name}'
-    columns = [obj_model_name]
-    query = SpecificQuery(session, sql, alias, columns)
 
-    query.register()
-    try:
-        objs_found = [result[obj_model_name] for result in query]
-    except CAT_NO_ROWS_FOUND:
-        objs_found = None
-    finally:
-        # If SQL query goes wrong, we should un-register the query.
-        # This should be equivalent (?) to `iadmin rsq $alias` (where $alias is: f'sql_missing_avu_{irods_obj_type}_{avu_name}')
-        query.remove()
+    objs_found = {avu_name: [] for avu_name in avu_names}
+    with specific_query(session, sql, [obj_model_name, obj_model_meta_name], args) as query:
+        try:
+            for result in query:
+                objs_found[result[obj_model_meta_name]].append(result[obj_model_name])
+        except CAT_NO_ROWS_FOUND:
+            pass
 
     return objs_found
 
 
-def missing_avu_non_sql(session, avu_name, irods_obj_type, obj_name_like=None, not_like=False):
+def obj_models(irods_obj_type):
     # depending on the iRODS object type, different tables/columns will be queried,
     # written out for the sake of explicitness
     if irods_obj_type == 'Collection':
-        obj_model = Collection
-        obj_model_meta =  CollectionMeta
+        return Collection, CollectionMeta
     elif irods_obj_type == 'User':
-        obj_model = User
-        obj_model_meta = UserMeta
+        return User, UserMeta
     else:
         raise Exception("iRODS object type not supported.")
 
-    objs = session.query(obj_model, obj_model_meta)
+
+# Query of `columns` over the objects of irods_obj_type that are checked
+def query_objs(session, irods_obj_type, columns, obj_name_like=None, not_like=False):
+    obj_model, obj_model_meta = obj_models(irods_obj_type)
+
+    objs = session.query(*columns)
 
     if obj_name_like:
         objs = objs.filter(Criterion(f"{'not like' if not_like else 'like'}", obj_model.name, obj_name_like))
@@ -184,113 +326,1035 @@ def missing_avu_non_sql(session, avu_name, irods_obj_type, obj_name_like=None, n
     if irods_obj_type == 'User':
         objs = objs.filter(User.type == 'rodsuser')
 
-    # this can probably be done more elegantly...
-    objs_dict = defaultdict(int)
+    return objs
+
+
+def chunks(items, size=IN_CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# With `names`, only the AVUs of those objects are indexed
+def avu_index_non_sql(session, irods_obj_type, obj_name_like=None, not_like=False, names=None):
+    obj_model, obj_model_meta = obj_models(irods_obj_type)
 
-    # 'obj' will be a dict with keys being the aggregate of fields in obj_model and obj_model_meta.
-    # Since there can be multiple AVUs (obj_model_meta) attached to a single a row in (obj_model),
-    # multiple obj could contain the same obj[obj_model.name]
+    # Only the object name and the attribute names are needed. GenQuery returns distinct rows, so every
+    # (object, attribute) pair is streamed once, no matter how many values the attribute has.
+    columns = (obj_model.name, obj_model_meta.name)
+    if names is None:
+        queries = [query_objs(session, irods_obj_type, columns, obj_name_like, not_like)]
+    else:
+        queries = [query_objs(session, irods_obj_type, columns, obj_name_like, not_like)
+                   .filter(In(obj_model.name, chunk)) for chunk in chunks(sorted(names))]
+
+    # Object name -> set of its attribute names.
+    # Note that objects without any AVU at all are not part of the join, so not part of the index either.
     # Check fields here: https://github.com/irods/python-irodsclient/blob/v1.0.0/irods/models.py
-    for obj in objs:
-        if (obj_model_meta.name, avu_name) in obj.items():
-            objs_dict[obj[obj_model.name]] += 1
-        else:
-            objs_dict[obj[obj_model.name]] += 0
+    index = defaultdict(set)
+    for objs in queries:
+        for obj in objs:
+            index[obj[obj_model.name]].add(obj[obj_model_meta.name])
+
+    return index
+
+
+# Returns the names of the objects that were modified, or got an AVU modified, after `since`.
+# GenQuery only has the modify time of the AVU itself (r_meta_main). iRODS reuses an existing AVU with the same
+# attribute, value and units when it is added to another object, so an added AVU is not always noticed, see
+# changed_objects_sql. Removing an AVU leaves no trace in modify times, a --full run picks that up.
+def changed_objects_non_sql(session, irods_obj_type, since, obj_name_like=None, not_like=False):
+    obj_model, obj_model_meta = obj_models(irods_obj_type)
+
+    changed = set()
+    for modify_time in (obj_model.modify_time, obj_model_meta.modify_time):
+        objs = query_objs(session, irods_obj_type, [obj_model.name], obj_name_like, not_like) \
+            .filter(modify_time > since)
+        changed.update(obj[obj_model.name] for obj in objs)
+
+    return changed
+
+
+# Same as changed_objects_non_sql, but also with the modify time of the link between object and AVU
+# (r_objt_metamap), which is set whenever an AVU is added to the object, also when the AVU itself is reused.
+def changed_objects_sql(session, irods_obj_type, since, obj_name_like=None, not_like=False):
+    # depending on the iRODS object type, different tables/columns will be queried,
+    # written out for the sake of explicitness
+    if irods_obj_type == 'Collection':
+        obj_table = 'r_coll_main'
+        obj_column_name = 'coll_name'
+        obj_column_id = 'coll_id'
+        obj_model_name = Collection.name
+    elif irods_obj_type == 'User':
+        obj_table = 'r_user_main'
+        obj_column_name = 'user_name'
+        obj_column_id = 'user_id'
+        obj_model_name = User.name
+    else:
+        raise Exception("iRODS object type not supported.")
 
-    return [k for k, v in objs_dict.items() if v == 0]
+    # The iCAT stores modify times as zero-padded strings of seconds since the epoch, so they compare as strings
+    modify_ts = f"{epoch(since):011d}"
+    conditions = list()
+    args = [modify_ts, modify_ts, modify_ts]
+    if obj_name_like:
+        conditions.append(f"o.{obj_column_name} {'NOT LIKE' if not_like else 'LIKE'} ?")
+        args.append(obj_name_like)
+    if irods_obj_type == 'User':
+        conditions.append("o.user_type_name = ?")
+        args.append('rodsuser')
 
+    sql = f"""
+    SELECT o.{obj_column_name}
+    FROM {obj_table} AS o
+    WHERE (o.modify_ts > ? OR EXISTS (
+        SELECT 1
+        FROM r_objt_metamap
+        JOIN r_meta_main ON r_meta_main.meta_id = r_objt_metamap.meta_id
+        WHERE r_objt_metamap.object_id = o.{obj_column_id}
+        AND (r_objt_metamap.modify_ts > ? OR r_meta_main.modify_ts > ?)
+    )){''.join(' AND ' + condition for condition in conditions)}
+    """
 
-# Returns list of logical paths to iRODS data objects that have less than num_replicas
-def missing_replicated_non_sql(session, auto_repl_rescs=True, repl_rescs_names=None, num_replicas=2, not_like=False):
+    changed = set()
+    with specific_query(session, sql, [obj_model_name], args) as query:
+        try:
+            changed.update(result[obj_model_name] for result in query)
+        except CAT_NO_ROWS_FOUND:
+            pass
+
+    return changed
+
+
+# Returns the names of all objects of irods_obj_type that are checked
+def obj_names_non_sql(session, irods_obj_type, obj_name_like=None, not_like=False):
+    obj_model, obj_model_meta = obj_models(irods_obj_type)
+    objs = query_objs(session, irods_obj_type, [obj_model.name], obj_name_like, not_like)
+    return {obj[obj_model.name] for obj in objs}
+
+
+# Returns, for every attribute name in avu_names, the list of objects in the index that miss it
+def missing_avus(index, avu_names):
+    return {avu_name: [name for name, attrs in index.items() if avu_name not in attrs] for avu_name in avu_names}
+
+
+# Returns the values of the attributes avu_names, as attribute name -> list of (object name, value).
+# With `names`, only the values of those objects are returned.
+def avu_values_non_sql(session, irods_obj_type, avu_names, obj_name_like=None, not_like=False, names=None):
+    obj_model, obj_model_meta = obj_models(irods_obj_type)
+
+    columns = (obj_model.name, obj_model_meta.name, obj_model_meta.value)
+    objs = query_objs(session, irods_obj_type, columns, obj_name_like, not_like) \
+        .filter(In(obj_model_meta.name, list(avu_names)))
+    if names is None:
+        queries = [objs]
+    else:
+        queries = [objs.filter(In(obj_model.name, chunk)) for chunk in chunks(sorted(names))]
+
+    values = defaultdict(list)
+    for objs in queries:
+        for obj in objs:
+            values[obj[obj_model_meta.name]].append((obj[obj_model.name], obj[obj_model_meta.value]))
+
+    return values
+
+
+# Returns, for every attribute with a value pattern, the (object name, value) pairs that do not match it.
+# Every attribute is evaluated as a whole column of values against its single, precompiled pattern.
+def invalid_values(values, value_patterns):
+    return {avu_name: [(name, value) for name, value in values.get(avu_name, ()) if not pattern.match(value)]
+            for avu_name, pattern in value_patterns.items()}
+
+
+# Returns the IDs of the 'storage resources' under replication
+def replication_resource_ids(session, auto_repl_rescs=True, repl_rescs_names=None):
     if auto_repl_rescs and repl_rescs_names:
         log.debug("Was ask to discover replication resources and was also provided a list: will auto discover.")
 
-    # list of IDs of 'storage resources' under replication
-    repl_rescs_ids = None
-
     if auto_repl_rescs:
         log.debug("Will try to find storage resources under replication")
         # the 'children' field seems to not be set :/
         # find all IDs for all  'coordinating resources' of type 'replication' (see README)
-        repl_coor_rescs = session.query(Resource).filter(Resource.type == 'replication')
+        repl_coor_rescs = session.query(Resource.id).filter(Resource.type == 'replication')
         repl_coor_rescs_ids = [repl_resc[Resource.id] for repl_resc in repl_coor_rescs]
+        if not repl_coor_rescs_ids:
+            return []
         # find all 'storage resources' under them
-        repl_rescs = session.query(Resource).filter(In(Resource.parent, repl_coor_rescs_ids))
+        repl_rescs = session.query(Resource.id).filter(In(Resource.parent, repl_coor_rescs_ids))
     else:
-        repl_rescs = session.query(Resource).filter(In(Resource.name, repl_rescs_names))
+        repl_rescs = session.query(Resource.id).filter(In(Resource.name, repl_rescs_names))
 
     repl_rescs_ids = [repl_resc[Resource.id] for repl_resc in repl_rescs]
     log.debug(f"Replication rescs ids: {repl_rescs_ids}")
 
-    # Query data objects living under replication resources
-    objs = session.query(DataObject, Collection).filter(In(DataObject.resc_id, repl_rescs_ids))
+    return repl_rescs_ids
+
+
+# Returns the ids of the data objects on the replication resources with a replica modified after `since`
+def changed_data_objects_non_sql(session, since, auto_repl_rescs=True, repl_rescs_names=None):
+    repl_rescs_ids = replication_resource_ids(session, auto_repl_rescs, repl_rescs_names)
+    if not repl_rescs_ids:
+        return set()
+
+    changed = session.query(DataObject.id) \
+        .filter(In(DataObject.resc_id, repl_rescs_ids)) \
+        .filter(DataObject.modify_time > since)
+
+    return {obj[DataObject.id] for obj in changed}
+
+
+# Returns the ids of the data objects in data_ids that still have a replica on the replication resources
+def existing_data_objects_non_sql(session, data_ids, auto_repl_rescs=True, repl_rescs_names=None):
+    repl_rescs_ids = replication_resource_ids(session, auto_repl_rescs, repl_rescs_names)
+    if not repl_rescs_ids:
+        return set()
+
+    existing = set()
+    for chunk in chunks(sorted(data_ids)):
+        objs = session.query(DataObject.id) \
+            .filter(In(DataObject.resc_id, repl_rescs_ids)) \
+            .filter(In(DataObject.id, chunk))
+        existing.update(obj[DataObject.id] for obj in objs)
+
+    return existing
+
+
+# Generates the data object id and logical path of iRODS data objects that have less than num_replicas
+# replicas on the replication resources. With `data_ids`, only those data objects are counted.
+def missing_replicated_non_sql(session, auto_repl_rescs=True, repl_rescs_names=None, num_replicas=2, not_like=False,
+                               data_ids=None):
+    repl_rescs_ids = replication_resource_ids(session, auto_repl_rescs, repl_rescs_names)
+    if not repl_rescs_ids:
+        log.warn("No replication resources found, cannot check replicas")
+        return
+
+    # Count replicas of each object in the iCAT: the data object id and names are grouped on, so the result is
+    # one row per data object instead of one per replica. GenQuery has no HAVING, the objects with
+    # < num_replicas are picked from the stream, page by page, without keeping any of them in memory.
+    def count_replicas():
+        return session.query(DataObject.id, Collection.name, DataObject.name) \
+            .count(DataObject.replica_number) \
+            .filter(In(DataObject.resc_id, repl_rescs_ids))
+
+    if data_ids is None:
+        queries = [count_replicas()]
+    else:
+        queries = [count_replicas().filter(In(DataObject.id, chunk)) for chunk in chunks(sorted(data_ids))]
+
+    for objs in queries:
+        for obj in objs:
+            if int(obj[DataObject.replica_number]) < num_replicas:
+                yield obj[DataObject.id], obj[Collection.name] + "/" + obj[DataObject.name]
+
+
+# Same as missing_replicated_non_sql, but counting and filtering (GROUP BY / HAVING) happen in the iCAT
+# database, so only the under-replicated data objects are returned.
+def missing_replicated_sql(session, auto_repl_rescs=True, repl_rescs_names=None, num_replicas=2):
+    repl_rescs_ids = replication_resource_ids(session, auto_repl_rescs, repl_rescs_names)
+    if not repl_rescs_ids:
+        log.warn("No replication resources found, cannot check replicas")
+        return
+
+    sql = """
+    SELECT d.data_id, c.coll_name, d.data_name
+    FROM r_data_main AS d
+    JOIN r_coll_main AS c ON c.coll_id = d.coll_id
+    WHERE d.resc_id = ANY(string_to_array(?, ',')::bigint[])
+    GROUP BY d.data_id, c.coll_name, d.data_name
+    HAVING COUNT(*) < ?::integer
+    ORDER BY d.data_id
+    """
+    args = [','.join(str(resc_id) for resc_id in repl_rescs_ids), str(num_replicas)]
+    with specific_query(session, sql, [DataObject.id, Collection.name, DataObject.name], args) as query:
+        try:
+            for obj in query:
+                yield int(obj[DataObject.id]), obj[Collection.name] + "/" + obj[DataObject.name]
+        except CAT_NO_ROWS_FOUND:
+            pass
+
+
+# Returns the collection matching `pattern` that coll_name is (in), or None. As the project and project collection
+# patterns have no '%', that collection is the start of coll_name of the length of the pattern.
+def like_prefix(coll_name, pattern):
+    name = coll_name[:len(pattern)]
+    if len(name) == len(pattern) and all(p in ('_', c) for p, c in zip(pattern, name)) \
+            and coll_name[len(name):][:1] in ('', '/'):
+        return name
+    return None
+
+
+# Returns the stored size and number of files AVUs of the project collections: name -> {attribute name: value}
+def stored_sizes_non_sql(session):
+    stored = defaultdict(dict)
+    avus = session.query(Collection.name, CollectionMeta.name, CollectionMeta.value) \
+        .filter(Criterion('like', Collection.name, PROJ_COLLS_PATH_LIKE)) \
+        .filter(In(CollectionMeta.name, [SIZE_AVU, NUM_FILES_AVU]))
+    for avu in avus:
+        stored[avu[Collection.name]][avu[CollectionMeta.name]] = avu[CollectionMeta.value]
+
+    return stored
+
+
+# Returns the size and number of data objects of every project collection, including its sub collections:
+# name -> (size, number of data objects). Every data object counts once, whatever its number of replicas.
+def collection_sizes_non_sql(session):
+    # GenQuery groups on the non-aggregated columns: one row per data object with the size of its largest replica.
+    # GenQuery has no sub queries, so the rows are summed per project collection here, as they stream by.
+    objs = session.query(Collection.name, DataObject.id) \
+        .max(DataObject.size) \
+        .filter(Criterion('like', Collection.name, PROJ_COLLS_PATH_LIKE + '%'))
 
-    # count replicas of each object
-    objs_dict = defaultdict(int)
+    sizes = defaultdict(lambda: (0, 0))
     for obj in objs:
-        #log.debug(f"{obj[Collection.name]} {obj[DataObject.name]}")
-        objs_dict[obj[Collection.name] + "/" + obj[DataObject.name]] += 1
+        name = like_prefix(obj[Collection.name], PROJ_COLLS_PATH_LIKE)
+        if name is not None:
+            size, num_files = sizes[name]
+            sizes[name] = (size + int(obj[DataObject.size]), num_files + 1)
 
-    # filter objs with < num_replicas
-    # Alternative: we could use DataObject.id for the dict key and then
-    # query Collection.name separately instead of that concatenation
-    return [k for k, v in objs_dict.items() if v < num_replicas]
+    return sizes
 
 
-def main():
-    warns = 0
-    args = parse_args()
+# Same as collection_sizes_non_sql, but the sizes are summed in the iCAT database, so only one row per project
+# collection is returned
+def collection_sizes_sql(session):
+    sql = """
+    SELECT o.proj_coll, SUM(o.data_size), COUNT(*)
+    FROM (
+        SELECT DISTINCT ON (d.data_id) left(c.coll_name, ?::integer) AS proj_coll, d.data_size
+        FROM r_data_main AS d
+        JOIN r_coll_main AS c ON c.coll_id = d.coll_id
+        WHERE c.coll_name LIKE ? OR c.coll_name LIKE ?
+        ORDER BY d.data_id, d.data_size DESC
+    ) AS o
+    GROUP BY o.proj_coll
+    """
+    args = [str(len(PROJ_COLLS_PATH_LIKE)), PROJ_COLLS_PATH_LIKE, PROJ_COLLS_PATH_LIKE + '/%']
 
-    with irods_session(args.env_file) as session:
-        # TODO: this can be refactored to avoid duplication!
-        log.debug("Checking missing AVUs for projects..")
-        for avu_name in PROJS_AVU_LIST:
-            log.debug(f"Checking AVU {avu_name}..")
-            projs_missing_avu = missing_avu_non_sql(session, avu_name, 'Collection', PROJS_PATH_LIKE)
-            #projs_missing_avu = missing_avu_sql(session, avu_name, 'Collection', PROJS_PATH_LIKE) # NOT TESTED
-            if projs_missing_avu:
-                for proj in projs_missing_avu:
-                    warns += 1
-                    log.warn(f"Project {proj} is missing AVU \"{avu_name}\"")
-            else:
-                log.info(f"No project seems to be missing AVU \"{avu_name}\"")
-
-        log.debug("Checking missing AVUs for project collections..")
-        for avu_name in PROJ_COLLS_AVU_LIST:
-            log.debug(f"Checking AVU {avu_name}..")
-            colls_missing_avu = missing_avu_non_sql(session, avu_name, 'Collection', PROJ_COLLS_PATH_LIKE)
-            #colls_missing_avu = missing_avu_sql(session, avu_name, 'Collection', PROJ_COLLS_PATH_LIKE) # NOT TESTED
-            if colls_missing_avu:
-                for coll in colls_missing_avu:
+    sizes = defaultdict(lambda: (0, 0))
+    with specific_query(session, sql, [Collection.name, DataObject.size, DataObject.id], args) as query:
+        try:
+            for row in query:
+                sizes[row[Collection.name]] = (int(row[DataObject.size]), int(row[DataObject.id]))
+        except CAT_NO_ROWS_FOUND:
+            pass
+
+    return sizes
+
+
+# Returns the project collections whose stored size or number of files AVU differs from the actual one:
+# name -> {attribute name: [stored value, actual value]}. Project collections without these AVUs are left to the
+# AVU checks.
+def size_drift(stored, sizes):
+    drifted = defaultdict(dict)
+    for name, avus in stored.items():
+        size, num_files = sizes[name]
+        for avu_name, actual in ((SIZE_AVU, size), (NUM_FILES_AVU, num_files)):
+            if avu_name not in avus:
+                continue
+            try:
+                matches = float(avus[avu_name]) == actual
+            except ValueError:
+                matches = False
+            if not matches:
+                drifted[name][avu_name] = [avus[avu_name], actual]
+
+    return dict(drifted)
+
+
+# Generates (data object id, collection name, data object name, resource name, checksum) of every replica in the
+# zone, ordered by data object id, so the replicas of a data object are next to each other in the stream.
+# The resource is the storage resource of the replica: DataObject.resource_name is the root of the resource
+# hierarchy (e.g. the replication resource) since iRODS 4.2, so the resource id is looked up instead.
+def replica_checksums_non_sql(session):
+    resource_names = {int(resc[Resource.id]): resc[Resource.name]
+                      for resc in session.query(Resource.id, Resource.name)}
+    replicas = session.query(DataObject.id, Collection.name, DataObject.name, DataObject.replica_number,
+                             DataObject.resc_id, DataObject.checksum) \
+        .order_by(DataObject.id)
+    for replica in replicas:
+        yield (int(replica[DataObject.id]), replica[Collection.name], replica[DataObject.name],
+               resource_names.get(int(replica[DataObject.resc_id])), replica[DataObject.checksum] or '')
+
+
+# Same as replica_checksums_non_sql, but the iCAT database only returns the replicas of data objects with a replica
+# without checksum or with differing checksums
+def replica_checksums_sql(session):
+    sql = """
+    SELECT d.data_id, c.coll_name, d.data_name, r.resc_name, d.data_checksum
+    FROM r_data_main AS d
+    JOIN r_coll_main AS c ON c.coll_id = d.coll_id
+    JOIN r_resc_main AS r ON r.resc_id = d.resc_id
+    WHERE d.data_id IN (
+        SELECT data_id
+        FROM r_data_main
+        GROUP BY data_id
+        HAVING bool_or(coalesce(data_checksum, '') = '') OR COUNT(DISTINCT NULLIF(data_checksum, '')) > 1
+    )
+    ORDER BY d.data_id
+    """
+    columns = [DataObject.id, Collection.name, DataObject.name, DataObject.resource_name, DataObject.checksum]
+    with specific_query(session, sql, columns) as query:
+        try:
+            for replica in query:
+                yield (int(replica[DataObject.id]), replica[Collection.name], replica[DataObject.name],
+                       replica[DataObject.resource_name], replica[DataObject.checksum] or '')
+        except CAT_NO_ROWS_FOUND:
+            pass
+
+
+# Returns the findings of the checksum audit of the replicas stream (see replica_checksums_non_sql), per kind
+# ('missing': data objects with a replica without checksum, 'differing': data objects with replicas with differing
+# checksums): the number of data objects, that number per resource (of the replicas concerned) and per project, and
+# the first list_limit data objects. Only the replicas of one data object are kept in memory at a time.
+def checksum_audit(replicas, list_limit=AUDIT_LIST_LIMIT):
+    audit = {kind: {'objects': 0, 'resources': defaultdict(int), 'projects': defaultdict(int), 'listed': []}
+             for kind in ('missing', 'differing')}
+    for data_id, obj_replicas in groupby(replicas, key=lambda replica: replica[0]):
+        obj_replicas = list(obj_replicas)
+        _, coll_name, data_name, _, _ = obj_replicas[0]
+        checksums = {checksum for *_, checksum in obj_replicas if checksum}
+        for kind, rescs in (('missing', {resc for *_, resc, checksum in obj_replicas if not checksum}),
+                            ('differing', {resc for *_, resc, _ in obj_replicas} if len(checksums) > 1 else set())):
+            if not rescs:
+                continue
+            findings = audit[kind]
+            findings['objects'] += 1
+            for resc in rescs:
+                findings['resources'][resc] += 1
+            findings['projects'][like_prefix(coll_name, PROJS_PATH_LIKE) or ''] += 1
+            if len(findings['listed']) < list_limit:
+                findings['listed'].append(coll_name + "/" + data_name)
+
+    return audit
+
+
+def epoch(modify_time):
+    return timegm(modify_time.utctimetuple())
+
+
+# Streams the objects that are checked by avu_checks (and the project collections, for the size check), their
+# AVUs, the resources and all data object replicas from the iCAT into a new SQLite snapshot, which records the
+# rules it was exported for. It is written next to snapshot_file and swapped in when complete.
+def export_snapshot(session, snapshot_file, avu_checks, rules):
+    if os.path.exists(snapshot_file + ".tmp"):
+        os.remove(snapshot_file + ".tmp")
+
+    with closing(sqlite3.connect(snapshot_file + ".tmp")) as db:
+        db.executescript(SNAPSHOT_SCHEMA)
+        db.executemany("INSERT INTO snapshot VALUES (?, ?)", [
+            ('created', datetime.now(timezone.utc).isoformat()),
+            ('host', session.host),
+            ('zone', session.zone),
+            ('rules', json.dumps(rules, sort_keys=True)),
+        ])
+
+        # The objects of every rule, once per name pattern. Patterns may overlap, the AVUs of an object that was
+        # exported before are skipped.
+        selections = dict.fromkeys([(check.irods_obj_type, check.obj_name_like, check.not_like)
+                                    for check in avu_checks] + [('Collection', PROJ_COLLS_PATH_LIKE, False)])
+        exported = set()
+        for irods_obj_type, obj_name_like, not_like in selections:
+            obj_model, obj_model_meta = obj_models(irods_obj_type)
+            log.debug(f"Exporting {irods_obj_type} {'not ' if not_like else ''}{obj_name_like or ''}..")
+            objs = session.query(obj_model.name, obj_model.modify_time,
+                                 *([User.type] if irods_obj_type == 'User' else []))
+            avus = session.query(obj_model.name, obj_model_meta.name, obj_model_meta.value,
+                                 obj_model_meta.units, obj_model_meta.modify_time)
+            if obj_name_like:
+                objs = objs.filter(Criterion('not like' if not_like else 'like', obj_model.name, obj_name_like))
+                avus = avus.filter(Criterion('not like' if not_like else 'like', obj_model.name, obj_name_like))
+
+            previously_exported = set(exported)
+            for obj in objs:
+                if (irods_obj_type, obj[obj_model.name]) not in exported:
+                    exported.add((irods_obj_type, obj[obj_model.name]))
+                    db.execute("INSERT INTO objects VALUES (?, ?, ?, ?)", (
+                        irods_obj_type, obj[obj_model.name], obj.get(User.type), epoch(obj[obj_model.modify_time])))
+            db.executemany("INSERT INTO avus VALUES (?, ?, ?, ?, ?, ?)", (
+                (irods_obj_type, avu[obj_model.name], avu[obj_model_meta.name], avu[obj_model_meta.value],
+                 avu[obj_model_meta.units], epoch(avu[obj_model_meta.modify_time]))
+                for avu in avus if (irods_obj_type, avu[obj_model.name]) not in previously_exported))
+
+        log.debug("Exporting resources..")
+        db.executemany("INSERT INTO resources VALUES (?, ?, ?, ?)", (
+            (int(resc[Resource.id]), resc[Resource.name], resc[Resource.type], resc[Resource.parent])
+            for resc in session.query(Resource.id, Resource.name, Resource.type, Resource.parent)))
+
+        log.debug("Exporting replicas..")
+        replicas = session.query(DataObject.id, Collection.name, DataObject.name, DataObject.replica_number,
+                                 DataObject.resc_id, DataObject.size, DataObject.checksum, DataObject.modify_time)
+        db.executemany("INSERT INTO replicas VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (
+            (int(obj[DataObject.id]), obj[Collection.name], obj[DataObject.name], int(obj[DataObject.replica_number]),
+             int(obj[DataObject.resc_id]), int(obj[DataObject.size]), obj[DataObject.checksum],
+             epoch(obj[DataObject.modify_time]))
+            for obj in replicas))
+
+        db.executescript(SNAPSHOT_INDEXES)
+        db.commit()
+
+        for table in ('objects', 'avus', 'resources', 'replicas'):
+            log.info(f"Exported {db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]} {table}")
+
+    os.replace(snapshot_file + ".tmp", snapshot_file)
+
+
+# Returns the value of `key` in the snapshot table, or None
+def snapshot_value(db, key):
+    row = db.execute("SELECT value FROM snapshot WHERE key = ?", [key]).fetchone()
+    return row[0] if row else None
+
+
+# Same as missing_avus_sql, against a snapshot
+def missing_avus_snapshot(db, avu_names, irods_obj_type, obj_name_like=None, not_like=False):
+    if not avu_names:
+        return {}
+
+    conditions = ["o.type = ?"]
+    args = list(avu_names) + [irods_obj_type]
+    if obj_name_like:
+        conditions.append(f"o.name {'NOT LIKE' if not_like else 'LIKE'} ?")
+        args.append(obj_name_like)
+    if irods_obj_type == 'User':
+        conditions.append("o.user_type = 'rodsuser'")
+    conditions.append("NOT EXISTS (SELECT 1 FROM avus AS a "
+                      "WHERE a.type = o.type AND a.name = o.name AND a.attribute = e.attribute)")
+
+    sql = f"""
+    WITH expected(attribute) AS (VALUES {', '.join('(?)' for _ in avu_names)})
+    SELECT o.name, e.attribute
+    FROM objects AS o
+    CROSS JOIN expected AS e
+    WHERE {' AND '.join(conditions)}
+    ORDER BY o.name, e.attribute
+    """
+
+    objs_found = {avu_name: [] for avu_name in avu_names}
+    for name, avu_name in db.execute(sql, args):
+        objs_found[avu_name].append(name)
+
+    return objs_found
+
+
+# Same as avu_values_non_sql, against a snapshot
+def avu_values_snapshot(db, irods_obj_type, avu_names, obj_name_like=None, not_like=False):
+    conditions = ["o.type = ?", f"a.attribute IN ({', '.join('?' for _ in avu_names)})"]
+    args = [irods_obj_type] + list(avu_names)
+    if obj_name_like:
+        conditions.append(f"o.name {'NOT LIKE' if not_like else 'LIKE'} ?")
+        args.append(obj_name_like)
+    if irods_obj_type == 'User':
+        conditions.append("o.user_type = 'rodsuser'")
+
+    sql = f"""
+    SELECT o.name, a.attribute, a.value
+    FROM objects AS o
+    JOIN avus AS a ON a.type = o.type AND a.name = o.name
+    WHERE {' AND '.join(conditions)}
+    """
+
+    values = defaultdict(list)
+    for name, avu_name, value in db.execute(sql, args):
+        values[avu_name].append((name, value))
+
+    return values
+
+
+# Same as replication_resource_ids, against a snapshot
+def replication_resource_ids_snapshot(db, auto_repl_rescs=True, repl_rescs_names=None):
+    if auto_repl_rescs:
+        rows = db.execute("SELECT id FROM resources WHERE parent IN "
+                          "(SELECT CAST(id AS TEXT) FROM resources WHERE type = 'replication')")
+    else:
+        rows = db.execute(f"SELECT id FROM resources WHERE name IN ({', '.join('?' for _ in repl_rescs_names)})",
+                          repl_rescs_names)
+
+    return [resc_id for resc_id, in rows]
+
+
+# Same as missing_replicated_sql, against a snapshot
+def missing_replicated_snapshot(db, auto_repl_rescs=True, repl_rescs_names=None, num_replicas=2):
+    repl_rescs_ids = replication_resource_ids_snapshot(db, auto_repl_rescs, repl_rescs_names)
+    if not repl_rescs_ids:
+        log.warn("No replication resources found, cannot check replicas")
+        return
+
+    sql = f"""
+    SELECT data_id, coll_name, data_name
+    FROM replicas
+    WHERE resc_id IN ({', '.join('?' for _ in repl_rescs_ids)})
+    GROUP BY data_id, coll_name, data_name
+    HAVING COUNT(*) < ?
+    ORDER BY data_id
+    """
+    for data_id, coll_name, data_name in db.execute(sql, repl_rescs_ids + [num_replicas]):
+        yield data_id, coll_name + "/" + data_name
+
+
+# Findings of the AVU checks: object name -> {attribute name: None when missing, or the list of its invalid values}
+def avu_findings(objs_missing, objs_invalid, findings=None):
+    findings = defaultdict(dict, findings or {})
+    for avu_name, objs_missing_avu in objs_missing.items():
+        for obj in objs_missing_avu:
+            findings[obj][avu_name] = None
+    for avu_name, objs_invalid_avu in objs_invalid.items():
+        for obj, value in objs_invalid_avu:
+            findings[obj].setdefault(avu_name, []).append(value)
+
+    return dict(findings)
+
+
+# Returns the findings of the AVU check, see avu_findings.
+# With `since` only objects changed after it are checked, and merged into the `previous` findings of the objects
+# that still exist.
+def find_missing_avus(session, check, sql=False, since=None, previous=None):
+    log.debug(f"Checking AVUs of {check.plural}..")
+    names = None
+    if since is None:
+        # One query for all attributes of all objects, instead of one per attribute
+        if sql:
+            objs_missing = missing_avus_sql(session, check.required, check.irods_obj_type, check.obj_name_like,
+                                            check.not_like)
+        else:
+            index = avu_index_non_sql(session, check.irods_obj_type, check.obj_name_like, check.not_like)
+            objs_missing = missing_avus(index, check.required)
+    else:
+        changed_objects = changed_objects_sql if sql else changed_objects_non_sql
+        names = changed_objects(session, check.irods_obj_type, since, check.obj_name_like, check.not_like)
+        log.debug(f"{len(names)} {check.plural} changed since last run")
+        # Objects that were removed leave no modify time, their findings are dropped by name
+        existing = obj_names_non_sql(session, check.irods_obj_type, check.obj_name_like, check.not_like)
+        previous = {obj: avus for obj, avus in previous.items() if obj in existing and obj not in names}
+        index = avu_index_non_sql(session, check.irods_obj_type, check.obj_name_like, check.not_like, names=names)
+        if sql:
+            # Like missing_avus_sql in a full run, also report changed objects without any AVU, which are not in the
+            # join of the index
+            for name in names & existing:
+                index.setdefault(name, set())
+        objs_missing = missing_avus(index, check.required)
+
+    # One more query for the values of all attributes with a value rule
+    objs_invalid = {}
+    if check.value_patterns and names != set():
+        values = avu_values_non_sql(session, check.irods_obj_type, check.value_patterns, check.obj_name_like,
+                                    check.not_like, names=names)
+        objs_invalid = invalid_values(values, check.value_patterns)
+
+    return avu_findings(objs_missing, objs_invalid, previous)
+
+
+# Same as replica_checksums_sql, against a snapshot
+def replica_checksums_snapshot(db):
+    sql = """
+    SELECT p.data_id, p.coll_name, p.data_name, r.name, coalesce(p.checksum, '')
+    FROM replicas AS p
+    LEFT JOIN resources AS r ON r.id = p.resc_id
+    WHERE p.data_id IN (
+        SELECT data_id
+        FROM replicas
+        GROUP BY data_id
+        HAVING MAX(coalesce(checksum, '') = '') OR COUNT(DISTINCT NULLIF(checksum, '')) > 1
+    )
+    ORDER BY p.data_id
+    """
+    yield from db.execute(sql)
+
+
+# Same as stored_sizes_non_sql and collection_sizes_non_sql, against a snapshot
+def collection_sizes_snapshot(db):
+    stored = defaultdict(dict)
+    for name, avu_name, value in db.execute(
+            "SELECT name, attribute, value FROM avus WHERE type = 'Collection' AND name LIKE ? AND attribute IN (?, ?)",
+            [PROJ_COLLS_PATH_LIKE, SIZE_AVU, NUM_FILES_AVU]):
+        stored[name][avu_name] = value
+
+    sql = """
+    SELECT substr(coll_name, 1, ?), SUM(size), COUNT(*)
+    FROM (
+        SELECT coll_name, MAX(size) AS size
+        FROM replicas
+        WHERE coll_name LIKE ? OR coll_name LIKE ?
+        GROUP BY data_id, coll_name
+    )
+    GROUP BY 1
+    """
+    sizes = defaultdict(lambda: (0, 0))
+    for name, size, num_files in db.execute(sql, [len(PROJ_COLLS_PATH_LIKE), PROJ_COLLS_PATH_LIKE,
+                                                  PROJ_COLLS_PATH_LIKE + '/%']):
+        sizes[name] = (size, num_files)
+
+    return stored, sizes
+
+
+# Same as find_missing_avus, against a snapshot
+def find_missing_avus_snapshot(db, check):
+    log.debug(f"Checking AVUs of {check.plural} in the snapshot..")
+    objs_missing = missing_avus_snapshot(db, check.required, check.irods_obj_type, check.obj_name_like,
+                                         check.not_like)
+    objs_invalid = {}
+    if check.value_patterns:
+        values = avu_values_snapshot(db, check.irods_obj_type, check.value_patterns, check.obj_name_like,
+                                     check.not_like)
+        objs_invalid = invalid_values(values, check.value_patterns)
+
+    return avu_findings(objs_missing, objs_invalid)
+
+
+# Logs the findings of find_missing_avus, returns the number of warnings
+def report_missing_avus(check, findings):
+    warns = 0
+    for avu_name in check.avu_names:
+        log.debug(f"Checking AVU {avu_name}..")
+        if avu_name in check.required:
+            objs_missing_avu = sorted(obj for obj, avus in findings.items() if avu_name in avus
+                                      and avus[avu_name] is None)
+            if objs_missing_avu:
+                for obj in objs_missing_avu:
                     warns += 1
-                    log.warn(f"Collection {coll} is missing AVU \"{avu_name}\"")
+                    log.warn(f"{check.label} {obj} is missing AVU \"{avu_name}\"")
             else:
-                log.info(f"No project collection seems to be missing AVU \"{avu_name}\"")
-
-        log.debug("Checking missing AVUS for users..")
-        for avu_name in USERS_AVU_LIST:
-            log.debug(f"Checking AVU {avu_name}..")
-            users_missing_avu = missing_avu_non_sql(session, avu_name, 'User', USERS_NOT_LIKE, not_like=True)
-            #users_missing_avu = missing_avu_sql(session, avu_name, 'User', USERS_NOT_LIKE, not_like=True) # NOT TESTED
-            if users_missing_avu:
-                for user in users_missing_avu:
-                    warns += 1
-                    log.warn(f"User {user} is missing AVU \"{avu_name}\"")
+                log.info(f"No {check.plural[:-1]} seems to be missing AVU \"{avu_name}\"")
+
+        if avu_name in check.value_patterns:
+            objs_invalid_avu = sorted((obj, avus[avu_name]) for obj, avus in findings.items()
+                                      if avus.get(avu_name) is not None)
+            if objs_invalid_avu:
+                for obj, values in objs_invalid_avu:
+                    for value in values:
+                        warns += 1
+                        log.warn(f"{check.label} {obj} has an invalid value \"{value}\" for AVU \"{avu_name}\"")
             else:
-                log.info(f"No user seems to be missing AVU \"{avu_name}\"")
+                log.info(f"No {check.plural[:-1]} seems to have an invalid value for AVU \"{avu_name}\"")
+
+    return warns
 
-#        log.debug("Checking not-sufficiently replicated data objects...")
-#        missing_repls = missing_replicated_non_sql(session, auto_repl_rescs=AUTO_REPL_RESC, repl_rescs_names=REPL_RESCS)
-#        for missing_repl in missing_repls:
-#            warns += 1
-#            log.warn(f"Data object: {missing_repl} is not sufficiently replicated.")
 
-        if warns != 0:
-            log.warn(f"There were a total of {warns} WARNINGs")
+# Returns the findings: data object id -> logical path of the not-sufficiently replicated data objects.
+# Data object ids are JSON object keys in the state file, so strings.
+def find_missing_replicas(session, sql=False, since=None, previous=None):
+    log.debug("Checking not-sufficiently replicated data objects...")
+    findings = dict()
+    if since is None:
+        missing_replicated = missing_replicated_sql if sql else missing_replicated_non_sql
+        for data_id, missing_repl in missing_replicated(session, auto_repl_rescs=AUTO_REPL_RESC,
+                                                        repl_rescs_names=REPL_RESCS):
+            findings[str(data_id)] = missing_repl
+    else:
+        # Changed data objects are checked again, counting all their replicas, the others keep their
+        # previous finding as long as they exist
+        changed = changed_data_objects_non_sql(session, since, auto_repl_rescs=AUTO_REPL_RESC,
+                                               repl_rescs_names=REPL_RESCS)
+        log.debug(f"{len(changed)} data objects changed since last run")
+        existing = existing_data_objects_non_sql(session, [int(data_id) for data_id in previous],
+                                                 auto_repl_rescs=AUTO_REPL_RESC, repl_rescs_names=REPL_RESCS)
+        findings.update((data_id, missing_repl) for data_id, missing_repl in previous.items()
+                        if int(data_id) not in changed and int(data_id) in existing)
+        if changed:
+            for data_id, missing_repl in missing_replicated_non_sql(session, auto_repl_rescs=AUTO_REPL_RESC,
+                                                                    repl_rescs_names=REPL_RESCS, data_ids=changed):
+                findings[str(data_id)] = missing_repl
+
+    return findings
+
+
+# Same as find_missing_replicas, against a snapshot
+def find_missing_replicas_snapshot(db):
+    log.debug("Checking not-sufficiently replicated data objects in the snapshot...")
+    return {str(data_id): missing_repl for data_id, missing_repl in
+            missing_replicated_snapshot(db, auto_repl_rescs=AUTO_REPL_RESC, repl_rescs_names=REPL_RESCS)}
+
+
+# Logs the findings of find_missing_replicas, returns the number of warnings
+def report_missing_replicas(findings):
+    warns = 0
+    for missing_repl in sorted(findings.values()):
+        warns += 1
+        log.warn(f"Data object: {missing_repl} is not sufficiently replicated.")
+
+    return warns
+
+
+# Returns the findings of the size check, see size_drift
+def find_size_drift(session, sql=False):
+    log.debug("Checking size and number of files of project collections...")
+    stored = stored_sizes_non_sql(session)
+    sizes = collection_sizes_sql(session) if sql else collection_sizes_non_sql(session)
+
+    return size_drift(stored, sizes)
+
+
+# Same as find_size_drift, against a snapshot
+def find_size_drift_snapshot(db):
+    log.debug("Checking size and number of files of project collections in the snapshot...")
+    return size_drift(*collection_sizes_snapshot(db))
+
+
+# Logs the findings of find_size_drift, returns the number of warnings
+def report_size_drift(findings):
+    warns = 0
+    for name, avus in sorted(findings.items()):
+        for avu_name, (stored, actual) in sorted(avus.items()):
+            warns += 1
+            log.warn(f"Collection {name} has AVU \"{avu_name}\" {stored}, but actually {actual}")
+    if not findings:
+        log.info("No project collection seems to have a wrong size or number of files")
+
+    return warns
+
+
+# Returns the findings of the checksum audit, see checksum_audit
+def find_checksum_audit(session, sql=False):
+    log.debug("Auditing the checksums of all replicas...")
+    return checksum_audit(replica_checksums_sql(session) if sql else replica_checksums_non_sql(session))
+
+
+# Same as find_checksum_audit, against a snapshot
+def find_checksum_audit_snapshot(db):
+    log.debug("Auditing the checksums of all replicas in the snapshot...")
+    return checksum_audit(replica_checksums_snapshot(db))
+
+
+# Logs the findings of find_checksum_audit, returns the number of warnings: one per data object
+def report_checksum_audit(findings):
+    warns = 0
+    for kind, description in (('missing', "has replicas without checksum"),
+                              ('differing', "has replicas with differing checksums")):
+        audit = findings[kind]
+        if not audit['objects']:
+            log.info(f"No data object seems to {description.replace('has', 'have', 1)}")
+            continue
+
+        warns += audit['objects']
+        for path in audit['listed']:
+            log.warn(f"Data object: {path} {description}.")
+        objects = f"data objects {description.replace('has', 'with', 1)}"
+        if audit['objects'] > len(audit['listed']):
+            log.warn(f"... and {audit['objects'] - len(audit['listed'])} more {objects}.")
+        for resc, count in sorted(audit['resources'].items()):
+            log.warn(f"{count} {objects} on resource {resc}.")
+        for project, count in sorted(audit['projects'].items()):
+            log.warn(f"{count} {objects} in {f'project {project}' if project else 'no project'}.")
+
+    return warns
+
+
+# Runs a single check on a connection of its own (`connect()`: iRODS session or snapshot), so checks can run
+# concurrently. The connection is in `connections` while the check runs, so it can be closed when the check times out.
+def run_check(connect, started, connections, key, find, *find_args):
+    started[key] = time.monotonic()
+    with connect() as connection:
+        connections[key] = connection
+        try:
+            return find(connection, *find_args)
+        finally:
+            connections.pop(key, None)
+
+
+# Stops a running check from another thread, by closing its connection: the check fails on its next (or current)
+# call. A running query of a snapshot is interrupted, the sockets of an iRODS session are shut down.
+def close_connection(connection):
+    try:
+        if isinstance(connection, sqlite3.Connection):
+            connection.interrupt()
         else:
-            log.info(f"There were no warnings. All seems to be in order.")
+            connection.cleanup()
+    except Exception as e:
+        log.debug(f"Closing connection: {e!r}")
+
+
+# The built-in rules: every attribute of the lists is required, values are not checked
+def default_rules():
+    return [
+        {'label': 'Project', 'plural': 'projects', 'type': 'Collection', 'like': PROJS_PATH_LIKE,
+         'attributes': {avu_name: {} for avu_name in PROJS_AVU_LIST}},
+        {'label': 'Collection', 'plural': 'project collections', 'type': 'Collection', 'like': PROJ_COLLS_PATH_LIKE,
+         'attributes': {avu_name: {} for avu_name in PROJ_COLLS_AVU_LIST}},
+        {'label': 'User', 'plural': 'users', 'type': 'User', 'not_like': USERS_NOT_LIKE,
+         'attributes': {avu_name: {} for avu_name in USERS_AVU_LIST}},
+    ]
+
+
+# Compiles the rules once into an AvuCheck per kind of object. All conditions on the value of an attribute (type,
+# regex, allowed values) become a single pattern, so every value is matched once, whatever the number of rules.
+def compile_rules(rules):
+    avu_checks = []
+    for rule in rules:
+        if rule.get('type') not in ('Collection', 'User'):
+            raise ValueError(f"Rule {rule.get('label')}: iRODS object type must be Collection or User")
+        if 'like' in rule and 'not_like' in rule:
+            raise ValueError(f"Rule {rule['label']}: use either like or not_like")
+
+        value_patterns = {}
+        for avu_name, expected in rule['attributes'].items():
+            patterns = []
+            if 'value_type' in expected:
+                if expected['value_type'] not in VALUE_TYPES:
+                    raise ValueError(f"Rule {rule['label']}, {avu_name}: unknown value type {expected['value_type']}")
+                patterns.append(VALUE_TYPES[expected['value_type']])
+            if 'regex' in expected:
+                patterns.append(expected['regex'])
+            if 'values' in expected:
+                patterns.append('|'.join(re.escape(value) for value in expected['values']))
+            if patterns:
+                try:
+                    value_patterns[avu_name] = re.compile(''.join(rf'(?=(?:{pattern})\Z)' for pattern in patterns))
+                except re.error as e:
+                    raise ValueError(f"Rule {rule['label']}, {avu_name}: invalid regex: {e}")
+
+        avu_checks.append(AvuCheck(
+            label=rule['label'],
+            plural=rule['plural'],
+            avu_names=list(rule['attributes']),
+            required=[avu_name for avu_name, expected in rule['attributes'].items() if expected.get('required', True)],
+            irods_obj_type=rule['type'],
+            obj_name_like=rule.get('like', rule.get('not_like')),
+            not_like='not_like' in rule,
+            value_patterns=value_patterns,
+        ))
+
+    return avu_checks
+
+
+def load_rules(rules_file):
+    with open(rules_file) as f:
+        return json.load(f)
+
+
+def load_state(state_file):
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_state(state_file, state):
+    # Write the new state next to the old one and swap, an interrupted run never leaves half a state file
+    with open(state_file + ".tmp", "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(state_file + ".tmp", state_file)
+
+
+def main():
+    warns = 0
+    args = parse_args()
+    started = int(time.time())
+
+    # The rules of the AVU checks, compiled once
+    try:
+        rules = load_rules(args.rules) if args.rules else default_rules()
+        avu_checks = compile_rules(rules)
+    except (OSError, ValueError, KeyError) as e:
+        log.error(f"Invalid rules {args.rules}: {e!r}")
+        return False
+
+    if args.export_snapshot:
+        with check_session(args.env_file, args.timeout) as session:
+            export_snapshot(session, args.export_snapshot, avu_checks, rules)
+        return True
+
+    # A snapshot only holds the objects of the rules it was exported for
+    if args.snapshot:
+        with open_snapshot(args.snapshot) as db:
+            snapshot_rules = snapshot_value(db, 'rules')
+        if snapshot_rules is None or json.loads(snapshot_rules) != rules:
+            log.error(f"Snapshot {args.snapshot} was not exported for these rules, export it again with them")
+            return False
+
+    # An incremental run needs the findings of a previous run that checked the same rules
+    state = load_state(args.state) if args.state and not args.full else None
+    if state is not None and state.get('rules') != rules:
+        log.info("The rules changed since the last run, checking all objects")
+        state = None
+    since = None
+    if state is not None:
+        since = datetime.fromtimestamp(state['watermark'], tz=timezone.utc)
+        log.info(f"Checking objects changed since {since.isoformat()}")
+
+    new_state = {
+        'watermark': started - WATERMARK_OVERLAP,
+        'rules': rules,
+        'findings': {},
+    }
+
+    # The checks hit independent tables, they run concurrently on a session each and are reported in this order.
+    # Checks, as: state key, description, find function and its arguments, report function and its arguments.
+    if args.snapshot:
+        connect = partial(open_snapshot, args.snapshot)
+        checks = [
+            (check.label, check.plural, find_missing_avus_snapshot, (check,), report_missing_avus, (check,))
+            for check in avu_checks
+        ]
+        checks.append(('replicas', 'replicas', find_missing_replicas_snapshot, (), report_missing_replicas, ()))
+        if args.check_sizes:
+            checks.append(('sizes', 'project collection sizes', find_size_drift_snapshot, (), report_size_drift, ()))
+        if args.audit_checksums:
+            checks.append(('checksums', 'checksums', find_checksum_audit_snapshot, (), report_checksum_audit, ()))
+    else:
+        connect = partial(check_session, args.env_file, args.timeout)
+        checks = [
+            (check.label, check.plural, find_missing_avus,
+             (check, args.sql, since, state['findings'][check.label] if state else None),
+             report_missing_avus, (check,))
+            for check in avu_checks
+        ]
+        checks.append(('replicas', 'replicas', find_missing_replicas,
+                       (args.sql, since, state['findings']['replicas'] if state else None),
+                       report_missing_replicas, ()))
+        # Aggregates all data objects in the projects, so only on request, and always all project collections
+        if args.check_sizes:
+            checks.append(('sizes', 'project collection sizes', find_size_drift, (args.sql,), report_size_drift, ()))
+        # Goes over all replicas in the zone, so only on request, and always all of them
+        if args.audit_checksums:
+            checks.append(('checksums', 'checksums', find_checksum_audit, (args.sql,), report_checksum_audit, ()))
+
+    failed = 0
+    check_started = dict()
+    connections = dict()
+    executor = ThreadPoolExecutor(max_workers=args.jobs)
+    futures = [executor.submit(run_check, connect, check_started, connections, key, find, *find_args)
+               for key, _, find, find_args, _, _ in checks]
+    try:
+        for (key, description, _, _, report, report_args), future in zip(checks, futures):
+            # Every check has its own timeout, counting from when it started
+            while not future.done():
+                wait([future], timeout=1)
+                if args.timeout and key in check_started and time.monotonic() - check_started[key] > args.timeout:
+                    break
+
+            if not future.done():
+                failed += 1
+                log.error(f"Check of {description} did not finish within {args.timeout} seconds, stopping it")
+                if key in connections:
+                    close_connection(connections[key])
+                continue
+            try:
+                findings = future.result()
+            except Exception as e:
+                # A failing check does not stop the others
+                failed += 1
+                log.error(f"Check of {description} failed: {e!r}")
+                continue
+
+            warns += report(*report_args, findings)
+            new_state['findings'][key] = findings
+    finally:
+        # Checks still running (after a Ctrl-C, or a timeout) are stopped, the interpreter waits for them at exit
+        for connection in list(connections.values()):
+            close_connection(connection)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # A state with the findings of a failed check would hide them from the next incremental run
+    if args.state and not failed:
+        save_state(args.state, new_state)
+
+    if failed:
+        log.error(f"{failed} checks did not complete")
+    if warns != 0:
+        log.warn(f"There were a total of {warns} WARNINGs")
+    elif not failed:
+        log.info(f"There were no warnings. All seems to be in order.")
 
-        return warns == 0
+    return warns == 0 and not failed
 
 
 if __name__ == "__main__":